@@ -0,0 +1,134 @@
+"""
+Micro-benchmarks of parsing and formatting functions that run on every command.
+Miha Lotric, Dec 2019
+
+Run from the repository root:
+    $ python -m benchmarks.hot_paths            # Compare with the stored baseline, exit 1 on regression
+    $ python -m benchmarks.hot_paths --update   # Store current results as the new baseline
+"""
+import argparse
+import tracemalloc
+import timeit
+import json
+import sys
+import os
+
+from cool_defi_bot.api.helpers import could_float, to_metric_prefix, round_sig
+from cool_defi_bot.api.api_handlers import get_formatted_input
+from cool_defi_bot.api.formatters import format_deepest, format_offer
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Fixtures shaped like upstream payloads, see `getters` for their schemas
+DEEPEST = [{'base': '0x0000000000000000000000000000000000000000', 'baseSymbol': 'ETH', 'baseName': 'Ether',
+            'exchange': f'0x{i:040x}', 'platform': platform, 'token': f'0x{i + 100:040x}',
+            'tokenSymbol': symbol, 'tokenName': name, 'usdLiquidity': liquidity, 'usdVolume': liquidity / 7,
+            'usdPrice': 171.23}
+           for i, (platform, symbol, name, liquidity) in enumerate([('uniswap', 'DAI', 'Dai Stablecoin', 53847261.2),
+                                                                    ('uniswap', 'MKR', 'Maker', 18291734.7),
+                                                                    ('bancor', 'BNT', 'Bancor', 9812736.1),
+                                                                    ('uniswap', 'SAI', 'Sai Stablecoin', 4123987.6),
+                                                                    ('kyber', 'KNC', 'Kyber Network', 987123.4)])]
+OFFER = {'aggregator': 'paraswap', 'from_token': 'ETH', 'to_token': 'DAI', 'from_amount': 10.0,
+         'to_amount': 1712.3456789, 'rate': 171.23456789, 'exchanges': {'uniswap': 62.5, 'kyber': 25, 'oasis': 12.5},
+         'quote_age': 3.2}
+ORDERS = [['dai'], ['2', 'dai'], ['dai', 'rep'], ['2.5', 'rep', 'dai'], ['dai', '2', 'eth']]
+VALUES = ['dai', 'REP', 'WETH', 'nan', '2', '0.5', '1e3', 'inf', 'Infinity', 'usdc']
+NUMBERS = [0.000123, 1.5, 999.9, 12345.678, 9876543.21, 123456789012.3]
+
+BENCHMARKS = {
+    'could_float': lambda: [could_float(value) for value in VALUES],
+    'to_metric_prefix': lambda: [to_metric_prefix(number) for number in NUMBERS],
+    'round_sig': lambda: [round_sig(number) for number in NUMBERS],
+    'get_formatted_input': lambda: [get_formatted_input(order, two_way=True) for order in ORDERS],
+    'format_deepest': lambda: format_deepest(DEEPEST),
+    'format_offer': lambda: format_offer(OFFER),
+}
+
+
+def reference():
+    """Fixed pure python workload, speeds are compared relative to it so baselines carry over between machines."""
+    return sorted(str(i * 7 % 13) for i in range(50))
+
+
+def ops_per_sec(timer, number, repeat=3):
+    """Return calls per second, best of repeat."""
+    return max(number / seconds for seconds in timer.repeat(repeat=repeat, number=number))
+
+
+def measure(fun, rounds=9, memory_calls=20):
+    """Return ops/sec, ops relative to `reference` and peak bytes allocated by one call (average of memory_calls).
+
+    Benchmark and reference are timed in alternating rounds and the median of both is used, so changes of CPU load
+    during the run affect them alike.
+    """
+    timer, reference_timer = timeit.Timer(fun), timeit.Timer(reference)
+    # Autorange picks numbers of calls taking at least 0.2s, rounds use a quarter of that
+    number, reference_number = [max(t.autorange()[0] // 4, 1) for t in (timer, reference_timer)]
+    samples = []
+    for _ in range(rounds):
+        samples.append((ops_per_sec(timer, number), ops_per_sec(reference_timer, reference_number)))
+    ops = sorted(ops for ops, _ in samples)[rounds // 2]
+    relative = sorted(ops / reference_ops for ops, reference_ops in samples)[rounds // 2]
+    peaks = []
+    for _ in range(memory_calls):
+        tracemalloc.start()
+        fun()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'ops_per_sec': round(ops),
+            'relative': round(relative, 4),
+            'peak_bytes': round(sum(peaks) / len(peaks))}
+
+
+def compare(results, baseline, threshold):
+    """Return descriptions of benchmarks that are slower or allocate more than baseline by more than threshold."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['relative'] < base['relative'] * (1 - threshold):
+            regressions.append(f"{name}: {result['relative']}x reference speed, baseline {base['relative']}x")
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + threshold):
+            regressions.append(f"{name}: {result['peak_bytes']} B/call, baseline {base['peak_bytes']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--update', action='store_true', help="Store results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed relative regression")
+    parser.add_argument('--only', nargs='*', help="Names of benchmarks to run")
+    options = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    results = {}
+    print(f"{'benchmark':<22}{'ops/sec':>10}{'relative':>10}{'baseline':>10}{'B/call':>10}{'baseline':>10}")
+    for name, fun in BENCHMARKS.items():
+        if options.only and name not in options.only:
+            continue
+        results[name] = measure(fun)
+        base = baseline.get(name, {})
+        result = results[name]
+        print(f"{name:<22}{result['ops_per_sec']:>10}{result['relative']:>10}{base.get('relative', '-'):>10}"
+              f"{result['peak_bytes']:>10}{base.get('peak_bytes', '-'):>10}")
+
+    if options.update:
+        with open(BASELINE, 'w') as file:
+            json.dump(dict(baseline, **results), file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f"Baseline stored in {BASELINE}")
+        return
+    regressions = compare(results, baseline, options.threshold)
+    for regression in regressions:
+        print(f"Regression {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
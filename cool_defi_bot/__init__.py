@@ -1,6 +1,13 @@
-from .api import getters
-from .api import formatters
-from .api import getters
-from .api import custom_exceptions
-from .api import helpers
-from .api import api_handlers
\ No newline at end of file
+import importlib
+
+# Api modules are imported on first access, so importing the package doesn't pull in numpy and requests
+API_MODULES = ('getters', 'formatters', 'custom_exceptions', 'helpers', 'api_handlers', 'quote_cache',
+               'cache_backends', 'token_registry', 'spread_scanner', 'returns_table', 'cassette')
+
+
+def __getattr__(name):
+    if name in API_MODULES:
+        module = importlib.import_module(f'.api.{name}', __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,20 +2,23 @@
 Functions providing formatted response to user arguments.
 Miha Lotric 2019
 """
-from dotenv import load_dotenv
-import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
-from cool_defi_bot.api.custom_exceptions import FormatError, DataError
-from cool_defi_bot.api.helpers import api_call, could_float
+from cool_defi_bot.api.custom_exceptions import FormatError, DataError, APIError, DeadlineExceeded
+from cool_defi_bot.api.helpers import api_call, could_float, disabled_aggregators
 import cool_defi_bot.api.getters as gt
 import cool_defi_bot.api.formatters as ft
+import cool_defi_bot.api.spread_scanner as scanner
+import cool_defi_bot.api.returns_table as returns_table
 import cool_defi_bot.config as config
+from cool_defi_bot import tracing
 
 
-load_dotenv()  # Load keys from .env file
-POOLS_KEY = os.getenv("POOLS_KEY")  # Blocklytics pools API key
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
 
 
+@tracing.traced
 def get_pool(request):
     """Return pool info for a specific token.
     Args:
@@ -36,13 +39,17 @@ def get_pool(request):
     address = token_data['exchange']
     if not address:
         raise DataError('<b>No results found</b>\nTry a different symbol.')
-    annualized_returns = gt.get_token_annualized(address, days)
+    try:
+        annualized_returns = gt.get_token_annualized(address, days)
+    except DeadlineExceeded:
+        annualized_returns = []  # Pool data is still sent, returns are shown as n/a
     annualized_returns = annualized_returns[0] if len(annualized_returns) else {}
     # Format the data
     formatted_response = ft.format_annualized_returns(token_data, annualized_returns)
     return formatted_response, address
 
 
+@tracing.traced
 def get_deepest():
     """Return tokens with largest liquidities.
 
@@ -55,11 +62,12 @@ def get_deepest():
                   'direction': 'desc',
                   'key': POOLS_KEY
                   }
-    response = api_call(url, params=api_params)
+    response = api_call(url, params=api_params, hedge=True)
     formatted_response = ft.format_deepest(response['results'])
     return formatted_response
 
 
+@tracing.traced
 def get_aggregator_offer(order, aggregator):
     """"Return price and platform routing for exchange aggregators.
 
@@ -69,18 +77,98 @@ def get_aggregator_offer(order, aggregator):
         Returns:
             str: HTML-formatted message.
     """
-    aggregator_fun = {"dexag": gt.get_dexag_offer,
-                      "oneinch": gt.get_1inch_offer,
-                      "paraswap": gt.get_paraswap_offer,
-                      "zerox": gt.get_0x_offer}  # TODO move to config
     two_way = config.AGGREGATOR_PREFERENCES[aggregator]['two_way']
     default_token = config.AGGREGATOR_PREFERENCES[aggregator]['default_token']
     params = get_formatted_input(order, two_way=two_way, default_token=default_token)
-    result = aggregator_fun[aggregator](params)
+    result = gt.OFFER_FUNCTIONS[aggregator](params)
     formatted = ft.format_offer(result)
     return formatted
 
 
+@tracing.traced
+def get_price_impact(order):
+    """Return effective rates and price impact for a ladder of order sizes.
+
+    Args:
+        order [list]: Args specifying user's request. It can start with an aggregator command name (eg. '0x'),
+                      otherwise all aggregators from config are quoted. Aggregators with disabled commands are
+                      never quoted. Remaining args are the same as for aggregator offers, except that only the
+                      selling amount can be specified.
+    Returns:
+        str: HTML-formatted message.
+    """
+    order = list(order)
+    disabled = disabled_aggregators()
+    commands = dict([(command, aggregator) for command, aggregator in config.AGGREGATOR_COMMANDS.items()
+                     if aggregator not in disabled])
+    if order and order[0].lower() in commands:
+        aggregators = [commands[order.pop(0).lower()]]
+    else:
+        aggregators = [aggregator for aggregator in config.IMPACT_PREFERENCES['aggregators']
+                       if aggregator not in disabled]
+    sizes = np.array(config.IMPACT_PREFERENCES['sizes'], dtype=float)
+    # Every aggregator can have a different default token
+    preferences = config.AGGREGATOR_PREFERENCES
+    orders = dict([(aggregator, get_formatted_input(order, default_token=preferences[aggregator]['default_token']))
+                   for aggregator in aggregators])
+    if not aggregators or any(params['fromAmount'] is None for params in orders.values()):
+        # Ladder scales the selling amount, orders like '100 DAI' give the other one
+        raise FormatError("<b>Please check the formatting.</b>\nTry it:\n<code>/impact 100 DAI MKR</code>")
+
+    def resolve_tokens(aggregator):
+        # Token decimals are resolved once per aggregator and reused for every size
+        token_info_fun = gt.TOKEN_INFO_FUNCTIONS.get(aggregator)
+        params = orders[aggregator]
+        return token_info_fun(params['fromToken'], params['toToken']) if token_info_fun else None
+
+    def quote(aggregator, token_info, amount):
+        params = dict(orders[aggregator], fromAmount=amount)
+        args = (params, token_info) if token_info else (params,)
+        try:
+            offer = gt.SELL_OFFER_FUNCTIONS[aggregator](*args)
+        except (APIError, DataError, KeyError, ValueError, ZeroDivisionError):
+            return np.nan  # Missing rung is shown as n/a
+        return offer['to_amount'] / offer['from_amount']
+
+    with ThreadPoolExecutor(max_workers=config.IMPACT_PREFERENCES['max_workers']) as executor:
+        token_futures = [tracing.submit(executor, resolve_tokens, aggregator) for aggregator in aggregators]
+        token_infos, errors = {}, []
+        for aggregator, future in zip(aggregators, token_futures):
+            try:
+                token_infos[aggregator] = future.result()
+            except (APIError, DataError) as e:
+                errors.append(e)  # Aggregator that can't resolve the pair is left out of the ladder
+        aggregators = [aggregator for aggregator in aggregators if aggregator in token_infos]
+        if not aggregators:
+            raise errors[0]
+        futures = [[tracing.submit(executor, quote, aggregator, token_infos[aggregator],
+                                   orders[aggregator]['fromAmount'] * size)
+                    for size in sizes]
+                   for aggregator in aggregators]
+        rates = np.array([[future.result() for future in row] for row in futures], dtype=float)
+    if np.isnan(rates).all():
+        raise DataError('<b>No quotes found</b>\nPlease try another pair')
+
+    # Best rate per size is compared against the best rate of the smallest quoted size
+    masked = np.where(np.isnan(rates), -np.inf, rates)
+    best_index = masked.argmax(axis=0)
+    best_rates = masked.max(axis=0)
+    best_rates[np.isinf(best_rates)] = np.nan
+    reference = best_rates[~np.isnan(best_rates)][0]
+    impacts = (best_rates / reference - 1) * 100
+
+    first_order = orders[aggregators[0]]
+    data = {'from_token': first_order['fromToken'],
+            'to_token': first_order['toToken'],
+            'from_amounts': sizes * first_order['fromAmount'],
+            'rates': best_rates,
+            'impacts': impacts,
+            'aggregators': [aggregators[i] for i in best_index]
+            }
+    formatted = ft.format_impact(data)
+    return formatted
+
+
 def get_formatted_input(order, two_way=False, default_token='ETH'):
     """Check if passed arguments are valid and return them formatted.
 
@@ -149,3 +237,43 @@ def get_formatted_input(order, two_way=False, default_token='ETH'):
         raise DataError('Invalid token combination')
 
     return order_dict
+
+
+@tracing.traced
+def get_spreads(request):
+    """Return largest price differences between aggregators from the latest background scan.
+
+    Args:
+        request [list]: Args specifying user's request, optionally the number of rows.
+    Returns:
+        str: HTML-formatted message.
+    """
+    if len(request) > 1 or (request and not request[0].isdigit()):
+        raise FormatError("<b>Please check the formatting.</b>\nTry it:\n<code>/spreads</code>")
+    limit = min(int(request[0]) if request else 5, 20)
+    snapshot = scanner.latest()
+    if not snapshot:
+        raise DataError('<b>Spreads are not ready yet</b>\nPlease try again in a minute.')
+    formatted_response = ft.format_spreads(snapshot.top(limit), snapshot.timestamp)
+    return formatted_response
+
+
+@tracing.traced
+def get_top_pools(request):
+    """Return deepest pools ranked by annualized returns, from the table refreshed in the background.
+
+    Args:
+        request [list]: Args specifying user's request, optionally the period in days (7, 30 or 90).
+    Returns:
+        str: HTML-formatted message.
+    """
+    periods = ', '.join(str(days) for days in returns_table.PERIODS)
+    if len(request) > 1 or (request and (not request[0].isdigit() or int(request[0]) not in returns_table.PERIODS)):
+        raise FormatError(f"<b>Please check the formatting.</b>\nDays can be {periods}. Try it:\n"
+                          f"<code>/toppools 30</code>")
+    days = int(request[0]) if request else 30
+    table = returns_table.latest()
+    if not table:
+        raise DataError('<b>Returns are not ready yet</b>\nPlease try again in a minute.')
+    formatted_response = ft.format_top_pools(table.top(days), days, table.timestamp)
+    return formatted_response
@@ -0,0 +1,113 @@
+"""
+Pluggable key-value stores for caches shared by bot processes.
+Miha Lotric, Dec 2019
+"""
+import pickle
+import threading
+import time
+
+import cool_defi_bot.config as config
+
+
+CACHE_BACKEND = config.CACHE_BACKEND  # Empty for in-process cache, otherwise eg. redis://localhost:6379/0
+
+
+class DictBackend:
+    """In-process cache, shared only by threads of one process."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._data = {}  # key: (expiry timestamp, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return stored value or None if it doesn't exist or it is expired."""
+        entry = self._data.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def set(self, key, value, ttl):
+        """Store value under the key for ttl seconds."""
+        now = time.time()
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                # Drop expired entries and if that isn't enough all of them
+                self._data = dict([(k, v) for k, v in self._data.items() if v[0] > now])
+                if len(self._data) >= self.max_entries:
+                    self._data.clear()
+            self._data[key] = (now + ttl, value)
+
+
+class SharedDictBackend(DictBackend):
+    """Cache living in a `multiprocessing.Manager` process, shared by all processes which received its proxy.
+
+    Args:
+        shared_dict [DictProxy]: Dict created with `multiprocessing.Manager().dict()`.
+    """
+
+    def __init__(self, shared_dict, max_entries=100000):
+        super().__init__(max_entries)
+        self._data = shared_dict
+
+    def set(self, key, value, ttl):
+        """Store value under the key for ttl seconds."""
+        if len(self._data) >= self.max_entries:
+            now = time.time()
+            for k, v in list(self._data.items()):
+                if v[0] <= now:
+                    self._data.pop(k, None)
+        self._data[key] = (time.time() + ttl, value)
+
+    def __getstate__(self):
+        # Lock can't be pickled, so every process gets its own
+        return {'max_entries': self.max_entries, '_data': self._data}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class RedisBackend:
+    """Cache stored in a Redis-compatible server. Requires `redis` package.
+
+    Args:
+        url [str]: Server url, eg. redis://localhost:6379/0.
+    """
+    prefix = 'cool_defi_bot:'
+
+    def __init__(self, url):
+        import redis  # Optional dependency, only needed for this backend
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        """Return stored value or None if it doesn't exist or it is expired."""
+        value = self._client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        """Store value under the key for ttl seconds."""
+        self._client.set(self.prefix + key, pickle.dumps(value), px=max(int(ttl * 1000), 1))
+
+
+def get_backend(url=None):
+    """Return cache backend for a url. Empty url or 'memory' returns in-process backend."""
+    if not url or url == 'memory':
+        return DictBackend()
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported cache backend: {url}")
+
+
+_backend = get_backend(CACHE_BACKEND)
+
+
+def current():
+    """Return cache backend used by this process."""
+    return _backend
+
+
+def use(backend):
+    """Set cache backend used by this process."""
+    global _backend
+    _backend = backend
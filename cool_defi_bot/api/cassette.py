@@ -0,0 +1,129 @@
+"""
+Recording upstream responses to disk and replaying them, to reproduce production traffic offline.
+Miha Lotric, Dec 2019
+"""
+from requests.structures import CaseInsensitiveDict
+import requests
+import threading
+import gzip
+import json
+import time
+import os
+
+from cool_defi_bot.api.custom_exceptions import APIError
+import cool_defi_bot.config as config
+
+
+CASSETTE_MODE = config.CASSETTE_MODE  # Empty for live requests, 'record' or 'replay'
+
+MODES = ('record', 'replay')
+
+
+class Cassette:
+    """Upstream responses stored as gzip compressed JSON lines, one response per line, indexed by request key.
+
+    Args:
+        path [str]: Cassette file.
+        mode [str]: 'record' appends responses of real requests, 'replay' serves recorded responses instead.
+        latency [bool]: When replaying, take as long as the recorded request did.
+    """
+
+    def __init__(self, path, mode, latency=False):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.stats = {'recorded': 0, 'replayed': 0, 'missing': 0}
+        self._entries = {}  # request key: recorded responses in recorded order
+        self._cursors = {}  # request key: index of the next response to replay
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            self.load()
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def load(self):
+        """Read recorded responses from the cassette file."""
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                self._entries.setdefault(entry['key'], []).append(entry)
+
+    def record(self, key, url, response, elapsed):
+        """Append a response to the cassette.
+
+        Args:
+            key [str]: Request key, see `helpers.request_key`.
+            url [str]: Requested url, kept for reading the cassette.
+            response [requests.Response]: Response of the request.
+            elapsed [float]: Seconds the request took.
+        """
+        entry = {'key': key,
+                 'url': url,
+                 'status': response.status_code,
+                 'headers': dict([(name, response.headers[name]) for name in config.CASSETTE['headers']
+                                  if name in response.headers]),
+                 'text': response.text,
+                 'elapsed': round(elapsed, 4),
+                 'recorded': time.time()
+                 }
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            # Every append is its own gzip member, readers decompress them as one stream
+            with gzip.open(self.path, 'at', encoding='utf-8') as file:
+                file.write(line)
+            self.stats['recorded'] += 1
+
+    def play(self, key):
+        """Return the next recorded response for a request key.
+
+        Responses recorded several times for the same key are served in recorded order, the last one is repeated.
+
+        Raises:
+            APIError: If the request wasn't recorded.
+        """
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.stats['missing'] += 1
+                raise APIError('<b>API Unavailable</b>\nPlease try again later')
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = min(index + 1, len(entries) - 1)
+            self.stats['replayed'] += 1
+        entry = entries[index]
+        if self.latency:
+            time.sleep(entry['elapsed'])
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.url = entry['url']
+        response.encoding = 'utf-8'
+        response._content = entry['text'].encode('utf-8')
+        return response
+
+
+def get_cassette(mode=None, path=None, latency=None):
+    """Return cassette for a mode or None for live requests. Unset arguments are taken from `config.CASSETTE`."""
+    if not mode:
+        return None
+    return Cassette(path or config.CASSETTE['path'], mode,
+                    config.CASSETTE['latency'] if latency is None else latency)
+
+
+_cassette = get_cassette(CASSETTE_MODE)
+
+
+def current():
+    """Return cassette used by this process or None."""
+    return _cassette
+
+
+def use(cassette):
+    """Set cassette used by this process, None makes live requests."""
+    global _cassette
+    _cassette = cassette
@@ -8,3 +8,7 @@ class APIError(Exception):
 
 class DataError(Exception):
 	pass
+
+
+class DeadlineExceeded(APIError):
+	pass
@@ -0,0 +1,53 @@
+"""
+Per-command latency budget shared by all upstream calls of the command.
+Miha Lotric, Dec 2019
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import time
+
+from cool_defi_bot.api.custom_exceptions import DeadlineExceeded
+import cool_defi_bot.config as config
+
+
+_deadline = ContextVar('deadline', default=None)
+
+
+@contextmanager
+def budget(seconds):
+    """Limit the block to the number of seconds. Nested budgets can only shorten the deadline."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(min(deadline, current) if current else deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def budgeted(name):
+    """Decorate a function so it runs within the budget of `config.DEADLINES[name]` seconds, read on every call."""
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            with budget(config.DEADLINES[name]):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remaining():
+    """Return seconds left in the current budget or None if there is no budget."""
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline else None
+
+
+def call_timeout():
+    """Return timeout for the next upstream call or raise DeadlineExceeded if there isn't enough time left."""
+    left = remaining()
+    if left is None:
+        return config.DEADLINES['upstream_timeout']
+    if left < config.DEADLINES['min_call']:
+        raise DeadlineExceeded('<b>Request took too long</b>\nPlease try again later')
+    return min(left, config.DEADLINES['upstream_timeout'])
@@ -2,10 +2,15 @@
 Functions that format the final bot response text.
 Miha Lotric, Dec 2019
 """
-from cool_defi_bot.api.helpers import to_emoji, to_metric_prefix, round_sig
+from cool_defi_bot.api.helpers import to_emoji, to_metric_prefix, round_sig, aggregator_emoji
+import time
+from cool_defi_bot.profiling import memory_profiled
+from cool_defi_bot.tracing import traced
 import cool_defi_bot.config as config
 
 
+@traced
+@memory_profiled
 def format_annualized_returns(token_data, annualized_returns):
     """Return formatted pools data.
     Args:
@@ -41,6 +46,8 @@ def format_annualized_returns(token_data, annualized_returns):
     return formatted_response
 
 
+@traced
+@memory_profiled
 def format_deepest(data):
     """Return formatted deepest tokens by liquidity and their data
     Args:
@@ -85,6 +92,8 @@ def format_deepest(data):
     return coated
 
 
+@traced
+@memory_profiled
 def format_offer(data):
     """Return formatted aggregator offer.
      Args:
@@ -92,15 +101,102 @@ def format_offer(data):
     Returns:
         str: HTML-formatted response.
     """
-    emojis = config.EMOJIS['aggregators']
     aggregator = data.get('aggregator', '')
     platform_perc = '\n'.join([('  • ' + str(int(perc)) + '%' + ' ' + platform.capitalize())
                                for platform, perc in data['exchanges'].items()])
-    msg = f"<b>{emojis.get(aggregator, '')} {aggregator.capitalize()} price</b>\n" \
+    msg = f"<b>{aggregator_emoji(aggregator)} {aggregator.capitalize()} price</b>\n" \
           f"Send: <b>{round_sig(data['from_amount'])} {data['from_token']}</b>\n" \
           f"Receive: <b>{round_sig(data['to_amount'])} {data['to_token']}</b>\n" \
           f"Rate: <b>{round_sig(data['rate'])} {data['to_token']}/{data['from_token']}</b>\n\n" \
           "Trade routing\n" \
           f"{platform_perc}"
+    # Cached quotes are marked with their age
+    if data.get('quote_age', 0) >= 1:
+        msg += f"\n\n<i>Quoted {round(data['quote_age'])}s ago</i>"
+
+    return msg
+
+
+@traced
+@memory_profiled
+def format_impact(data):
+    """Return formatted price impact table.
+     Args:
+        data [dict]: Price impact ladder. With keys from_token, to_token, from_amounts, rates, impacts and aggregators.
+                     Rates that couldn't be quoted are NaN.
+    Returns:
+        str: HTML-formatted response.
+    """
+    headers = ['SIZE', 'RATE', 'IMPACT']
+    sizes = [to_metric_prefix(amount) for amount in data['from_amounts']]
+    quoted = [rate == rate for rate in data['rates']]  # NaN is not equal to itself
+    rates = [str(round_sig(rate)) if ok else 'n/a' for rate, ok in zip(data['rates'], quoted)]
+    impacts = [f"{impact:.2f}%" if ok else 'n/a' for impact, ok in zip(data['impacts'], quoted)]
+    vias = [aggregator_emoji(aggregator) if ok else '' for aggregator, ok in zip(data['aggregators'], quoted)]
+    # Column width is equal to the width of the longest string in it (including headers)
+    widths = [max([len(cell) for cell in column] + [len(header)])
+              for column, header in zip((sizes, rates, impacts), headers)]
+
+    # All columns are right-aligned
+    column_names = ' '.join([header.rjust(width) for header, width in zip(headers, widths)])
+    rows = [' '.join([cell.rjust(width) for cell, width in zip(cells, widths)]) + f" {via}"
+            for *cells, via in zip(sizes, rates, impacts, vias)]
+    msg = f"<b>Price impact {data['from_token']} → {data['to_token']}</b>\n" \
+          f"Rate in {data['to_token']}/{data['from_token']}\n" \
+          "<code>" + column_names + "\n" + "\n".join(rows) + "</code>"
+
+    return msg
+
+
+@traced
+@memory_profiled
+def format_spreads(rows, timestamp):
+    """Return formatted cross-aggregator spreads.
+     Args:
+        rows [list]: Spreads, largest first, as returned by `SpreadSnapshot.top`.
+        timestamp [float]: Time of the scan.
+    Returns:
+        str: HTML-formatted response.
+    """
+    age = round((time.time() - timestamp) / 60)
+    header = f"<b>Largest aggregator spreads</b>\n<i>Scanned {age} min ago</i>\n"
+    if not rows:
+        return header + "\nNo pair was quoted by two aggregators."
+    lines = [f"{i + 1}. <b>{to_metric_prefix(row['size'])} {row['from_token']} → {row['to_token']}</b> "
+             f"{row['spread']:.2f}%\n"
+             f"    {aggregator_emoji(row['best_aggregator'])} {round_sig(row['best'])} vs "
+             f"{aggregator_emoji(row['worst_aggregator'])} {round_sig(row['worst'])}"
+             for i, row in enumerate(rows)]
+
+    return header + "\n" + "\n".join(lines)
+
+
+@traced
+@memory_profiled
+def format_top_pools(rows, days, timestamp):
+    """Return formatted ranking of pools by annualized returns.
+     Args:
+        rows [list]: Tuples of pool name, address and annualized returns, largest returns first.
+        days [int]: Period of annualized returns.
+        timestamp [float]: Time returns were fetched.
+    Returns:
+        str: HTML-formatted response.
+    """
+    headers = ['#', 'POOL', f'D{days}']
+    pools = [pool for pool, _, _ in rows]
+    returns = [f"{round(value, 1)}%" for _, _, value in rows]
+    # Column width is equal to the width of the longest string in it (including headers)
+    num_len = max(len(str(len(rows))), len(headers[0]))
+    max_pool_len = max([len(pool) for pool in pools] + [len(headers[1])])
+    max_ret_len = max([len(value) for value in returns] + [len(headers[2])])
+
+    # All columns except for the last one are left-aligned, last on is right-aligned
+    column_names = f"{headers[0].ljust(num_len)} {headers[1].ljust(max_pool_len)} {headers[2].rjust(max_ret_len)}"
+    table = [f"{str(i + 1).ljust(num_len)} {pool.ljust(max_pool_len)} {value.rjust(max_ret_len)}"
+             for i, (pool, value) in enumerate(zip(pools, returns))]
+    age = round((time.time() - timestamp) / 60)
+    msg = f"<b>Top pools by {days} days annualized returns</b>\n" \
+          f"<i>Updated {age} min ago</i>\n" \
+          "<code>" + "\n".join([column_names] + table) + "</code>"
 
     return msg
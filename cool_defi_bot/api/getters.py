@@ -2,17 +2,18 @@
 Functions that fetch and manipulate data into common schemas.
 Miha Lotric, Dec 2019
 """
-import os
 from cool_defi_bot.api.custom_exceptions import DataError, APIError
-from dotenv import load_dotenv
 from cool_defi_bot.api.helpers import api_call
+from cool_defi_bot.api.quote_cache import cached_quote
+from cool_defi_bot.api.token_registry import REGISTRY
 from cool_defi_bot import config
+from cool_defi_bot.tracing import traced
 
 
-load_dotenv()  # Load keys from .env file
-POOLS_KEY = os.getenv("POOLS_KEY")  # Blocklytics pools API key
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
 
 
+@traced
 def get_token_pool(token):
     """Return pool data for a specific token.
 
@@ -24,18 +25,18 @@ def get_token_pool(token):
               usdLiquidity, usdPrice, usdVolume.
 
     Note:
-        There are some tokens with same symbol. Current API call requests them sorted by liquidity and this functions
-        returns only the token with the largest liquidity for a given symbol.
+        There are some tokens with same symbol. Token registry resolves the symbol to the token with the largest
+        liquidity.
     """
-    url = config.URLS['pools_exchanges']
-    response = api_call(url, {'key': POOLS_KEY})
-    exchanges = [row for row in response['results'] if str(row.get('tokenSymbol', '')).lower() == str(token).lower()]
-    if len(exchanges) == 0:
+    try:
+        token_data = REGISTRY.resolve(token, 'pools')
+    except DataError:
         raise DataError("Try a different symbol.")
 
-    return exchanges[0]  # Returning only the first result among all tokens with the same symbol
+    return token_data.pool  # Deepest pool among all tokens with the same symbol
 
 
+@traced
 def get_token_annualized(address, days):
     """Return annualized returns for a specific token.
 
@@ -48,11 +49,51 @@ def get_token_annualized(address, days):
               value [str]: Annualized returns.
     """
     url = f"{config.URLS['annualized_returns']}/{address}"
-    response = api_call(url, params={'daysBack': days, 'key': POOLS_KEY})
+    response = api_call(url, params={'daysBack': days, 'key': POOLS_KEY}, hedge=True)
 
     return response
 
 
+def get_token_pair(source, from_token, to_token):
+    """Return registry data for both tokens of an order as listed by a source.
+
+    Args:
+        source [str]: Token source, one of `token_registry.SOURCES`.
+        from_token [str]: Symbol for the token user is buying.
+        to_token [str]: Symbol for the token user is selling.
+    Returns:
+        dict: Token data (address, symbol, name, decimals) under keys 'from' and 'to'.
+    """
+    return {'from': REGISTRY.resolve(from_token, source).as_dict(source),
+            'to': REGISTRY.resolve(to_token, source).as_dict(source)}
+
+
+@traced
+def get_1inch_token_info(from_token, to_token):
+    """Return 1inch token data for both tokens of an order."""
+    return get_token_pair('oneinch', from_token, to_token)
+
+
+@traced
+def get_paraswap_token_info(from_token, to_token):
+    """Return paraswap token data (address and decimals) for both tokens of an order."""
+    return get_token_pair('paraswap', from_token, to_token)
+
+
+@traced
+def get_0x_token_info(from_token, to_token):
+    """Return 0x token data (address and decimals) for both tokens of an order."""
+    return get_token_pair('zerox', from_token, to_token)
+
+
+TOKEN_INFO_FUNCTIONS = {'oneinch': get_1inch_token_info,
+                        'paraswap': get_paraswap_token_info,
+                        'zerox': get_0x_token_info
+                        }  # dexag resolves tokens on its side
+
+
+@traced
+@cached_quote('dexag')
 def get_dexag_offer(user_params):
     """Return dexag offer for the best price based on a user order.
 
@@ -91,7 +132,7 @@ def get_dexag_offer(user_params):
 
     # 'REQUEST CALL'
     url = config.URLS['aggregators']['dexag']['offer']
-    response = api_call(url, api_params)
+    response = api_call(url, api_params, hedge=True)
     if response.get('error'):
         # With dexag token validity is not checked before API call
         raise DataError('<b>Token not found</b>\nPlease try another symbol')
@@ -119,7 +160,9 @@ def get_dexag_offer(user_params):
     return data
 
 
-def get_1inch_offer(user_params):
+@traced
+@cached_quote('oneinch')
+def get_1inch_offer(user_params, token_info=None):
     """Return 1inch offer for the best price based on a user order.
 
         Args:
@@ -130,6 +173,8 @@ def get_1inch_offer(user_params):
                                                                  If toAmount is specified it is None.
                                     toAmount [float/int/bool]: Amount of token user is selling.
                                                                If fromAmount is specified it is None.
+            token_info [dict]: Pre-resolved token data as returned by the matching token info function.
+                               If None it is fetched for the request.
 
         Returns:
             dict: Processed user request containing amount user wants to buy/sell, price and aggregators with specified
@@ -145,14 +190,9 @@ def get_1inch_offer(user_params):
                       aggregator [str]: Name of the aggregator offering this price - '1inch'.
     """
     # GET TOKEN INFO
-    url = config.URLS['aggregators']['oneinch']['tokens']
-    tokens = api_call(url)
-    # Capitalize keys in token dict in order to find them
-    tokens = dict([(symbol.upper(), data) for symbol, data in tokens.items()])
-    from_token_data = tokens.get(user_params['fromToken'])
-    to_token_data = tokens.get(user_params['toToken'])
-    if not (from_token_data and to_token_data):
-        raise DataError('<b>Token not found</b>\nPlease try another symbol')
+    token_info = token_info or get_1inch_token_info(user_params['fromToken'], user_params['toToken'])
+    from_token_data = token_info['from']
+    to_token_data = token_info['to']
 
     # PREPARE FOR REQUEST CALL
     api_params = {'fromTokenSymbol': user_params['fromToken'],
@@ -163,7 +203,7 @@ def get_1inch_offer(user_params):
 
     # REQUEST CALL
     url = config.URLS['aggregators']['oneinch']['offer']
-    response = api_call(url, api_params)
+    response = api_call(url, api_params, hedge=True)
     if (int(response['toTokenAmount']) == 0) and (user_params['fromAmount'] != 0):
         # 1inch tokens displays more tokens than it can actually offer
         raise DataError("<b>Token not found</b>\nPlease try another symbol")
@@ -186,7 +226,9 @@ def get_1inch_offer(user_params):
     return data
 
 
-def get_paraswap_offer(user_params):
+@traced
+@cached_quote('paraswap')
+def get_paraswap_offer(user_params, token_info=None):
     """Return paraswap offer for the best price based on a user order.
 
         Args:
@@ -197,6 +239,8 @@ def get_paraswap_offer(user_params):
                                                                  If toAmount is specified it is None.
                                     toAmount [float/int/bool]: Amount of token user is selling.
                                                                If fromAmount is specified it is None.
+            token_info [dict]: Pre-resolved token data as returned by the matching token info function.
+                               If None it is fetched for the request.
 
         Returns:
             dict: Processed user request containing amount user wants to buy/sell, price and aggregators with specified
@@ -212,30 +256,16 @@ def get_paraswap_offer(user_params):
                       aggregator [str]: Name of the aggregator offering this price - 'paraswap'.
     """
     # GET TOKEN INFO
-    url = config.URLS['aggregators']['paraswap']['tokens']
-    tokens = api_call(url)['tokens']  # Get all tokens paraswap can offer
-    # Search through list of token data until from-token and to-token are found
-    count = 0
-    for token_data in tokens:
-        if count == 2:
-            break
-        elif token_data['symbol'].upper() == user_params['fromToken'].upper():
-            from_address = token_data['address']
-            from_decimals = token_data['decimals']
-            count += 1
-        elif token_data['symbol'].upper() == user_params['toToken'].upper():
-            to_address = token_data['address']
-            to_decimals = token_data['decimals']
-            count += 1
-    else:
-        raise DataError("<b>Token not found</b>\nPlease try another symbol")
+    token_info = token_info or get_paraswap_token_info(user_params['fromToken'], user_params['toToken'])
+    from_address, from_decimals = token_info['from']['address'], token_info['from']['decimals']
+    to_address, to_decimals = token_info['to']['address'], token_info['to']['decimals']
 
     # 'PREPARE FOR REQUEST CALL'
     amount = user_params['fromAmount'] * 10**from_decimals
 
     # REQUEST CALL
     url = f"{config.URLS['aggregators']['paraswap']['offer']}/{from_address}/{to_address}/{amount}"
-    response = api_call(url)
+    response = api_call(url, hedge=True)
 
     # FORMAT IT
     result_amount = int(response['priceRoute']['amount']) * 10**-to_decimals
@@ -254,7 +284,9 @@ def get_paraswap_offer(user_params):
     return data
 
 
-def get_0x_offer(user_params):
+@traced
+@cached_quote('zerox')
+def get_0x_offer(user_params, token_info=None):
     """Return dexag offer for the best price based on a user order.
 
     Args:
@@ -265,6 +297,8 @@ def get_0x_offer(user_params):
                                                              If toAmount is specified it is None.
                                 toAmount [float/int/bool]: Amount of token user is selling.
                                                            If fromAmount is specified it is None.
+        token_info [dict]: Pre-resolved token data as returned by the matching token info function.
+                           If None it is fetched for the request.
 
     Returns:
         dict: Processed user request containing amount user wants to buy/sell, price and aggregators with specified
@@ -279,36 +313,40 @@ def get_0x_offer(user_params):
                                     value: Percentage.
                   aggregator [str]: Name of the aggregator offering this price - '0x'.
     """
+    return _get_0x_quote(user_params, token_info, sell_side=False)
+
+
+@traced
+@cached_quote('zerox_sell')
+def get_0x_sell_offer(user_params, token_info=None):
+    """Return 0x offer like `get_0x_offer`, but quoted for selling fromToken for toToken like other aggregators.
+
+    0x quotes orders from the side of the token it is given an amount of, `get_0x_offer` asks it to buy fromToken.
+    Offers that are compared with other aggregators' must be quoted for the same trade.
+    """
+    return _get_0x_quote(user_params, token_info, sell_side=True)
+
+
+def _get_0x_quote(user_params, token_info, sell_side):
     # GET TOKEN INFO
-    url = config.URLS['aggregators']['zerox']['tokens']
-    tokens = api_call(url)['records']
-    # Search through list of token data until from-token and to-token are found
-    count = 0
-    for token_data in tokens:
-        if count == 2:
-            break
-        elif token_data['symbol'].upper() == user_params['fromToken'].upper():
-            from_decimals = token_data['decimals']
-            count += 1
-        elif token_data['symbol'].upper() == user_params['toToken'].upper():
-            to_decimals = token_data['decimals']
-            count += 1
-    else:
-        raise DataError("<b>Token not found</b>\nPlease try another symbol")
-                  
+    token_info = token_info or get_0x_token_info(user_params['fromToken'], user_params['toToken'])
+    from_decimals = token_info['from']['decimals']
+    to_decimals = token_info['to']['decimals']
+
     # PREPARE FOR REQUEST CALL
-    api_params = {'buyToken': user_params['fromToken'],
-                  'sellToken': user_params['toToken'],
+    from_side, to_side = ('sell', 'buy') if sell_side else ('buy', 'sell')
+    api_params = {f'{from_side}Token': user_params['fromToken'],
+                  f'{to_side}Token': user_params['toToken'],
                   }
     selling = user_params['fromAmount']
     if selling:
-        api_params.update({'buyAmount': int(user_params['fromAmount'] * 10**from_decimals)})
+        api_params.update({f'{from_side}Amount': int(user_params['fromAmount'] * 10**from_decimals)})
     else:
-        api_params.update({'sellAmount': int(user_params['toAmount'] * 10**to_decimals)})
+        api_params.update({f'{to_side}Amount': int(user_params['toAmount'] * 10**to_decimals)})
 
     # REQUEST CALL
     url = config.URLS['aggregators']['zerox']['offer']
-    response = api_call(url, api_params)
+    response = api_call(url, api_params, hedge=True)
 
     # FORMAT IT
     relative_rate = float(response['price'])
@@ -333,3 +371,12 @@ def get_0x_offer(user_params):
             }
 
     return data
+
+
+OFFER_FUNCTIONS = {'dexag': get_dexag_offer,
+                   'oneinch': get_1inch_offer,
+                   'paraswap': get_paraswap_offer,
+                   'zerox': get_0x_offer
+                   }
+# Offers for selling fromToken for toToken, their rates are comparable between aggregators
+SELL_OFFER_FUNCTIONS = dict(OFFER_FUNCTIONS, zerox=get_0x_sell_offer)
@@ -0,0 +1,168 @@
+"""
+Hedged GET requests for upstreams with long-tailed latency.
+Miha Lotric, Dec 2019
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextvars import copy_context
+from collections import deque
+import threading
+import time
+
+from cool_defi_bot import tracing
+from cool_defi_bot import reloader
+import cool_defi_bot.config as config
+
+
+class LatencyTracker:
+    """Recent request latencies per endpoint."""
+
+    def __init__(self, samples=200):
+        self.samples = samples
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        """Add latency of a finished request."""
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen=self.samples)).append(seconds)
+
+    def percentile(self, endpoint, percentile, min_samples):
+        """Return latency percentile in seconds or None if there aren't enough samples."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(endpoint, ()))
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    def endpoints(self):
+        """Return endpoints with recorded latencies."""
+        with self._lock:
+            return list(self._latencies)
+
+
+class Hedger:
+    """Send a duplicate request when the first one is slower than usual and use whichever answers first.
+
+    Hedges are limited to `max_ratio` of all requests, so upstream load grows by at most that fraction. First requests
+    run on their own threads, so they start right away however many callers there are, only duplicates use the pool.
+
+    Args:
+        settings [dict]: See `config.HEDGING`.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.latencies = LatencyTracker()
+        self.counters = {'requests': 0, 'hedged': 0, 'hedge_won': 0, 'hedge_denied': 0}
+        self._allowance = 0  # Hedges currently allowed, grows by max_ratio with every request
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=settings['workers'], thread_name_prefix='hedge')
+
+    def delay(self, endpoint):
+        """Return seconds to wait for the first request before hedging, None if endpoint has too few samples."""
+        latency = self.latencies.percentile(endpoint, self.settings['percentile'], self.settings['min_samples'])
+        return max(latency, self.settings['min_delay']) if latency is not None else None
+
+    def _timed(self, endpoint, fun, *args, **kwargs):
+        start = time.monotonic()
+        result = fun(*args, **kwargs)
+        self.latencies.record(endpoint, time.monotonic() - start)
+        return result
+
+    def _start(self, endpoint, fun, *args, **kwargs):
+        """Run the first request on a new thread within the current trace and return its future."""
+        future = Future()
+        context = copy_context()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(context.run(self._timed, endpoint, fun, *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, name='hedge-primary', daemon=True).start()
+        return future
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._allowance >= 1:
+                self._allowance -= 1
+                self.counters['hedged'] += 1
+                return True
+            self.counters['hedge_denied'] += 1
+            return False
+
+    def call(self, endpoint, hedge, fun, *args, **kwargs):
+        """Return result of fun(*args, **kwargs), hedged with a second call if the first is slow.
+
+        Args:
+            endpoint [str]: Name latencies are tracked under.
+            hedge [bool]: If False the call is only timed.
+            fun [function]: Idempotent function making the request, eg. `requests.get`.
+        """
+        if not hedge:
+            return self._timed(endpoint, fun, *args, **kwargs)
+        with self._lock:
+            self.counters['requests'] += 1
+            self._allowance = min(self._allowance + self.settings['max_ratio'], self.settings['max_burst'])
+        delay = self.delay(endpoint)
+        if not self.settings['enabled'] or delay is None:
+            return self._timed(endpoint, fun, *args, **kwargs)
+
+        primary = self._start(endpoint, fun, *args, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+        with tracing.span('hedge', endpoint=endpoint, delay_ms=delay * 1000):
+            duplicate = tracing.submit(self._executor, self._timed, endpoint, fun, *args, **kwargs)
+            pending = {primary, duplicate}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        for other in pending:
+                            # Running requests can't be interrupted, their response is closed when it arrives
+                            if not other.cancel():
+                                other.add_done_callback(_close_response)
+                        if future is duplicate:
+                            with self._lock:
+                                self.counters['hedge_won'] += 1
+                        return future.result()
+            return primary.result()  # Both failed, raise the original error
+
+    def stats(self):
+        """Return request and hedge counters and current hedge delay of every endpoint in seconds."""
+        with self._lock:
+            counters = dict(self.counters)
+        delays = dict([(endpoint, self.delay(endpoint)) for endpoint in self.latencies.endpoints()])
+        return dict(counters, delays=delays)
+
+
+def _close_response(future):
+    if future.exception() is None and hasattr(future.result(), 'close'):
+        future.result().close()
+
+
+HEDGER = Hedger(config.HEDGING)
+
+
+def _apply_reloaded(changed):
+    """Let `HEDGER` use reloaded settings, it keeps its latencies and threads."""
+    if 'HEDGING' in changed:
+        HEDGER.settings = config.HEDGING
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def endpoint_name(url):
+    """Return configured url the request url starts with, so urls with path parameters are tracked together."""
+    return max([known for known in _known_urls(config.URLS) if url.startswith(known)], key=len, default=url)
+
+
+def _known_urls(urls):
+    for value in urls.values():
+        if isinstance(value, dict):
+            yield from _known_urls(value)
+        else:
+            yield value
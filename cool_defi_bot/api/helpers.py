@@ -2,10 +2,55 @@
 Functions helping execution of the main functions.
 Miha Lotric, Dec 2019
 """
-import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib.parse import urlencode
+from collections import deque
 from math import floor, log10
+import threading
+import requests
+import hashlib
+import time
+
+from cool_defi_bot.api.custom_exceptions import APIError, DeadlineExceeded
+from cool_defi_bot.api import deadline
+from cool_defi_bot.api import hedging
+from cool_defi_bot.api import cache_backends
+from cool_defi_bot.api import cassette
+from cool_defi_bot.profiling import memory_snapshot
+from cool_defi_bot.tracing import span
+from cool_defi_bot import reloader
+import cool_defi_bot.config as config
+
+ENCODINGS = ACCEPT_ENCODING  # Encodings urllib3 can decode, 'br' is included by versions supporting brotli
+
+
+def new_session():
+    """Return HTTP session with pooled connections to upstream APIs."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=config.HTTP_POOL['connections'], pool_maxsize=config.HTTP_POOL['maxsize'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ENCODINGS
+    return session
+
+
+SESSION = new_session()
+FETCH_STATS = {}  # endpoint: counters of requests, failures, not modified responses, bytes and decode time
+# Responses whose transferred size isn't known are counted in 'unmeasured' instead of 'bytes'
+_outcomes = {}  # endpoint: if recent requests succeeded
+_stats_lock = threading.Lock()
+NAN_INF = frozenset(['nan', 'inf', 'infinity'])  # Words float() accepts
+
+
+def _apply_reloaded(changed):
+    """Pool connections with the reloaded sizes, requests already sent finish on the old session."""
+    global SESSION
+    if 'HTTP_POOL' in changed:
+        SESSION = new_session()
 
-from cool_defi_bot.api.custom_exceptions import APIError
+
+reloader.add_listener(_apply_reloaded)
 
 
 def to_metric_prefix(num, sig=4):
@@ -55,8 +100,23 @@ def to_emoji(num):
         return '🙃'
 
 
+def aggregator_emoji(aggregator):
+    """Return an emoji of the aggregator.
+
+    Args:
+        aggregator [str]: Aggregator name (e.g. 'zerox') or its command (e.g. '0x').
+    Return:
+        str: Emoji, empty if aggregator has none.
+    """
+    aggregator = config.AGGREGATOR_COMMANDS.get(aggregator, aggregator)
+    return config.EMOJIS['aggregators'].get(aggregator, '')
+
+
 def could_float(value):
     """Return if string is a number."""
+    # Token symbols are the common case, raising and catching ValueError for them is several times slower
+    if isinstance(value, str) and value.isalpha() and value.lower() not in NAN_INF:
+        return 0
     try:
         float(value)
         return 1
@@ -71,10 +131,136 @@ def round_sig(x, sig=4):
     return rounded
 
 
-def api_call(url, params=None):
-    """Make an API call and return response."""
-    try:
-        return requests.get(url, params).json()
-    except:
-        # Original exception is picked up with traceback module in telegram_bot.py
-        raise APIError('<b>API Unavailable</b>\nPlease try again later')
+def disabled_aggregators():
+    """Return aggregators whose commands are disabled in config, they aren't called by commands or jobs."""
+    return [config.AGGREGATOR_COMMANDS[command] for command in config.DISABLED_COMMANDS
+            if command in config.AGGREGATOR_COMMANDS]
+
+
+def request_key(url, params=None):
+    """Return short key identifying a GET request."""
+    query = urlencode(sorted((params or {}).items()))
+    return 'api:' + hashlib.sha1(f"{url}?{query}".encode()).hexdigest()
+
+
+def transferred_bytes(response):
+    """Return number of bytes of the response body sent over the wire, before decompressing it.
+
+    Returns None for compressed chunked responses, urllib3 doesn't count bytes it reads in chunks.
+    """
+    if 'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    if response.raw is not None and response.raw.tell():
+        return response.raw.tell()
+    if response.headers.get('Content-Encoding', 'identity') == 'identity':
+        return len(response.content)
+    return None
+
+
+def record_fetch(endpoint, ok=True, **counters):
+    """Add counters to the fetch stats of an endpoint and remember if the request succeeded."""
+    with _stats_lock:
+        stats = FETCH_STATS.setdefault(endpoint, {'requests': 0, 'failures': 0, 'not_modified': 0, 'bytes': 0,
+                                                  'unmeasured': 0, 'decode_seconds': 0, 'last_success': None,
+                                                  'last_failure': None})
+        for name, value in counters.items():
+            stats[name] += value
+        stats['failures'] += not ok
+        stats['last_success' if ok else 'last_failure'] = time.time()
+        _outcomes.setdefault(endpoint, deque(maxlen=config.HEALTH['window'])).append(ok)
+
+
+def fetch_stats():
+    """Return a copy of the fetch counters of every endpoint."""
+    with _stats_lock:
+        return dict([(endpoint, dict(stats)) for endpoint, stats in FETCH_STATS.items()])
+
+
+def fetch_health():
+    """Return success rate of recent requests, their number and seconds since the last success and failure for every
+    endpoint. Ages are None if there wasn't any."""
+    now = time.time()
+    with _stats_lock:
+        return dict([(endpoint, {'success_rate': sum(_outcomes[endpoint]) / len(_outcomes[endpoint]),
+                                 'samples': len(_outcomes[endpoint]),
+                                 'last_success_age': now - stats['last_success'] if stats['last_success'] else None,
+                                 'last_failure_age': now - stats['last_failure'] if stats['last_failure'] else None})
+                     for endpoint, stats in FETCH_STATS.items()])
+
+
+def api_call(url, params=None, cache_ttl=None, hedge=False):
+    """Make an API call and return response.
+
+    Responses of calls with cache_ttl are stored with their ETag/Last-Modified validators. Once they expire, they are
+    requested conditionally and a 304 response refreshes the stored body instead of downloading it again.
+
+    With a recording cassette responses are also written to it, with a replaying one they are read from it instead of
+    requesting them, see `cassette`.
+
+    Args:
+        url [str]: Endpoint url.
+        params [dict]: Query parameters.
+        cache_ttl [int]: If set, response is shared through the cache backend for that many seconds.
+        hedge [bool]: Send a duplicate request if the first one is slower than usual for the endpoint.
+    Returns:
+        dict/list: Decoded JSON response.
+    """
+    with span('api_call', url=url) as attributes:
+        headers = {}
+        validated = None
+        key = request_key(url, params)
+        tape = cassette.current()
+        if cache_ttl:
+            cached = cache_backends.current().get(key)
+            attributes['cached'] = cached is not None
+            if cached is not None:
+                return cached
+            # Recorded responses need full bodies, they are replayed without the validated cache
+            validated = cache_backends.current().get(key + ':validated') if not tape else None
+            if validated and validated['etag']:
+                headers['If-None-Match'] = validated['etag']
+            if validated and validated['last_modified']:
+                headers['If-Modified-Since'] = validated['last_modified']
+        timeout = deadline.call_timeout()  # Each call gets whatever is left of the command's budget
+        endpoint = hedging.endpoint_name(url)
+        try:
+            if tape and tape.replaying:
+                response = tape.play(key)
+            else:
+                start = time.perf_counter()
+                response = hedging.HEDGER.call(endpoint, hedge, SESSION.get, url, params=params, headers=headers,
+                                               timeout=timeout)
+                if tape:
+                    tape.record(key, url, response, time.perf_counter() - start)
+            transferred = transferred_bytes(response)
+            attributes.update(status=response.status_code, bytes=transferred)
+            size = {'bytes': transferred} if transferred is not None else {'unmeasured': 1}
+            if response.status_code == 304 and validated:
+                record_fetch(endpoint, requests=1, not_modified=1, **size)
+                body = validated['body']
+            else:
+                start = time.perf_counter()
+                with memory_snapshot(f"decode {url}"):
+                    body = response.json()
+                record_fetch(endpoint, ok=response.status_code < 400, requests=1,
+                             decode_seconds=time.perf_counter() - start, **size)
+        except requests.Timeout:
+            if deadline.remaining() is not None and deadline.remaining() <= 0:
+                # Out of the command's budget, not the upstream's failure
+                raise DeadlineExceeded('<b>Request took too long</b>\nPlease try again later')
+            record_fetch(endpoint, ok=False, requests=1)
+            raise APIError('<b>API Unavailable</b>\nPlease try again later')
+        except:
+            record_fetch(endpoint, ok=False, requests=1)
+            # Original exception is picked up with traceback module in telegram_bot.py
+            raise APIError('<b>API Unavailable</b>\nPlease try again later')
+        success = 200 <= response.status_code < 300
+        # Error bodies aren't cached, the next call asks the upstream again
+        if cache_ttl and (success or (response.status_code == 304 and validated)):
+            cache_backends.current().set(key, body, cache_ttl)
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            if success and (etag or last_modified):
+                cache_backends.current().set(key + ':validated',
+                                             {'etag': etag, 'last_modified': last_modified, 'body': body},
+                                             config.HTTP_POOL['validator_ttl'])
+        return body
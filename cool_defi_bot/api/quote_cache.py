@@ -0,0 +1,107 @@
+"""
+Short-lived cache for aggregator quotes.
+Miha Lotric, Dec 2019
+"""
+from functools import wraps
+from math import log
+import threading
+import time
+
+from cool_defi_bot.api import cache_backends
+from cool_defi_bot import reloader
+import cool_defi_bot.config as config
+
+
+class QuoteCache:
+    """Cache of aggregator quotes with TTL and hit/miss counters. Quotes are kept in the process' cache backend."""
+
+    def __init__(self, ttl, bucket_ratio):
+        self.ttl = ttl
+        self.bucket_ratio = bucket_ratio
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, aggregator, user_params):
+        """Return normalized cache key for a user order.
+
+        Args:
+            aggregator [str]: Name of the aggregator.
+            user_params [dict]: User request as returned by `get_formatted_input`.
+        Returns:
+            str: Aggregator, selling token, buying token, direction and amount bucket.
+        """
+        selling = bool(user_params.get('fromAmount'))
+        amount = user_params['fromAmount'] if selling else user_params['toAmount']
+        # Logarithmic buckets, so the relative difference of amounts inside one bucket is bounded
+        bucket = round(log(float(amount), self.bucket_ratio))
+        return ':'.join(['quote',
+                         aggregator,
+                         str(user_params['fromToken']).upper(),
+                         str(user_params['toToken']).upper(),
+                         'sell' if selling else 'buy',
+                         str(bucket)])
+
+    def get(self, key):
+        """Return tuple of cached quote and its age in seconds or None if there is no fresh quote."""
+        entry = cache_backends.current().get(key)
+        with self._lock:
+            if entry:
+                self.hits += 1
+                return entry[1], time.time() - entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, quote):
+        """Store a quote under the key."""
+        cache_backends.current().set(key, (time.time(), quote), self.ttl)
+
+    def stats(self):
+        """Return hit/miss counters of this process."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+QUOTES = QuoteCache(**config.QUOTE_CACHE)
+
+
+def _apply_reloaded(changed):
+    """Let `QUOTES` use reloaded settings. Quotes cached under buckets of the old ratio expire unused."""
+    if 'QUOTE_CACHE' in changed:
+        QUOTES.ttl, QUOTES.bucket_ratio = config.QUOTE_CACHE['ttl'], config.QUOTE_CACHE['bucket_ratio']
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def rescale_quote(quote, user_params):
+    """Return a copy of a cached quote rescaled to the amount of the user order, keeping the rate."""
+    if user_params.get('fromAmount'):
+        factor = user_params['fromAmount'] / quote['from_amount']
+    else:
+        factor = user_params['toAmount'] / quote['to_amount']
+    return dict(quote,
+                from_token=user_params['fromToken'],
+                to_token=user_params['toToken'],
+                from_amount=quote['from_amount'] * factor,
+                to_amount=quote['to_amount'] * factor)
+
+
+def cached_quote(aggregator):
+    """Decorate an offer getter so its quotes are served from `QUOTES` while fresh.
+
+    Quotes returned from cache have 'quote_age' key with number of seconds since they were fetched.
+    """
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(user_params, *args, **kwargs):
+            key = QUOTES.key(aggregator, user_params)
+            cached = QUOTES.get(key)
+            if cached:
+                quote, age = cached
+                return dict(rescale_quote(quote, user_params), quote_age=age)
+            quote = fun(user_params, *args, **kwargs)
+            QUOTES.set(key, quote)
+            return dict(quote, quote_age=0)
+        return wrapper
+    return decorator
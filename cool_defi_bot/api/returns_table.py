@@ -0,0 +1,99 @@
+"""
+Background precomputed annualized returns of the deepest pools.
+Miha Lotric, Dec 2019
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import logging
+import time
+
+from cool_defi_bot.api.custom_exceptions import APIError, DataError
+from cool_defi_bot.api.helpers import api_call
+from cool_defi_bot.api import cache_backends
+import cool_defi_bot.api.getters as gt
+from cool_defi_bot import tracing
+import cool_defi_bot.config as config
+
+
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
+
+PERIODS = (7, 30, 90)  # Days of annualized returns, columns of the table
+
+logger = logging.getLogger(__name__)
+
+
+class ReturnsTable:
+    """Annualized returns of pools. `returns` has shape (pools, periods), missing values are NaN."""
+
+    def __init__(self, pools, addresses, returns):
+        self.pools = pools
+        self.addresses = addresses
+        self.returns = returns
+        self.timestamp = time.time()
+
+    def top(self, days, limit=10):
+        """Return pools with the largest annualized returns for a period, largest first.
+
+        Returns:
+            list: Tuples of pool name, address and annualized returns in percent.
+        """
+        column = self.returns[:, PERIODS.index(days)]
+        order = np.argsort(-np.where(np.isnan(column), -np.inf, column))[:limit]
+        order = order[~np.isnan(column[order])]
+        return [(self.pools[i], self.addresses[i], column[i]) for i in order]
+
+
+def latest():
+    """Return the latest table or None if it wasn't computed yet. Table is shared by all bot processes."""
+    return cache_backends.current().get('returns:latest')
+
+
+def get_top_pools(limit):
+    """Return (pool name, exchange address) of pools with largest liquidities."""
+    api_params = {'limit': limit,
+                  'orderBy': 'usdLiquidity',
+                  'direction': 'desc',
+                  'key': POOLS_KEY
+                  }
+    response = api_call(config.URLS['deepest'], params=api_params, cache_ttl=config.RETURNS_TABLE['interval'])
+    return [(f"{row['platform'].capitalize()} {row['baseSymbol']}-{row.get('tokenSymbol') or row.get('tokenName')}",
+             row['exchange'])
+            for row in response['results'] if row.get('exchange')]
+
+
+def refresh():
+    """Fetch annualized returns of the deepest pools and store the table.
+
+    Returns:
+        ReturnsTable: The new table.
+    """
+    settings = config.RETURNS_TABLE
+    pools = get_top_pools(settings['pools'])
+
+    def returns(address):
+        try:
+            response = gt.get_token_annualized(address, 1)
+        except (APIError, DataError):
+            return [np.nan] * len(PERIODS)
+        data = response[0] if len(response) else {}
+        return [data.get(f'D{days}_net_annualized', np.nan) for days in PERIODS]
+
+    with tracing.trace('job.returns_refresh', pools=len(pools)):
+        with ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
+            futures = [tracing.submit(executor, returns, address) for _, address in pools]
+            values = np.array([future.result() for future in futures], dtype=float).reshape(len(pools), len(PERIODS))
+    table = ReturnsTable([name for name, _ in pools], [address for _, address in pools], values)
+    cache_backends.current().set('returns:latest', table, settings['keep'])
+    return table
+
+
+def refresh_job(context=None):
+    """Job queue callback refreshing the table. Errors are logged so the job keeps running."""
+    table = latest()
+    if table and time.time() - table.timestamp < config.RETURNS_TABLE['interval'] / 2:
+        return  # Another process refreshed recently
+    try:
+        table = refresh()
+        logger.info(f"Returns table refreshed for {int((~np.isnan(table.returns)).any(axis=1).sum())} pools")
+    except Exception:
+        logger.exception("Returns table refresh failed")
@@ -0,0 +1,136 @@
+"""
+Background scanner quoting the deepest pairs on every aggregator and ranking cross-aggregator spreads.
+Miha Lotric, Dec 2019
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import logging
+import time
+
+from cool_defi_bot.api.custom_exceptions import APIError, DataError
+from cool_defi_bot.api.helpers import api_call, disabled_aggregators
+from cool_defi_bot.api import cache_backends
+import cool_defi_bot.api.getters as gt
+from cool_defi_bot import tracing
+import cool_defi_bot.config as config
+
+
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
+
+logger = logging.getLogger(__name__)
+
+
+class SpreadSnapshot:
+    """Quotes of one scan. `rates` has shape (pairs, aggregators, sizes), missing quotes are NaN."""
+
+    def __init__(self, pairs, aggregators, sizes, rates):
+        self.pairs = pairs
+        self.aggregators = aggregators
+        self.sizes = sizes
+        self.rates = rates
+        self.timestamp = time.time()
+
+    def spreads(self):
+        """Return arrays of best rate, worst rate, spread in percent and indexes of best and worst aggregators.
+
+        All arrays have shape (pairs, sizes). Spread is NaN where fewer than two aggregators quoted.
+        """
+        quoted = ~np.isnan(self.rates)
+        best_index = np.where(quoted, self.rates, -np.inf).argmax(axis=1)
+        worst_index = np.where(quoted, self.rates, np.inf).argmin(axis=1)
+        best = np.take_along_axis(self.rates, best_index[:, None, :], axis=1)[:, 0, :]
+        worst = np.take_along_axis(self.rates, worst_index[:, None, :], axis=1)[:, 0, :]
+        spread = np.where(quoted.sum(axis=1) >= 2, (best / worst - 1) * 100, np.nan)
+        return best, worst, spread, best_index, worst_index
+
+    def top(self, limit=5):
+        """Return pair/size combinations with the largest spreads, largest first.
+
+        Returns:
+            list: Dicts with keys from_token, to_token, size, spread, best, worst, best_aggregator, worst_aggregator.
+        """
+        best, worst, spread, best_index, worst_index = self.spreads()
+        flat = np.where(np.isnan(spread), -np.inf, spread).ravel()
+        order = np.argsort(-flat)[:limit]
+        order = order[np.isfinite(flat[order])]
+        rows = []
+        for pair_i, size_i in zip(*np.unravel_index(order, spread.shape)):
+            rows.append({'from_token': self.pairs[pair_i][0],
+                         'to_token': self.pairs[pair_i][1],
+                         'size': self.sizes[size_i],
+                         'spread': spread[pair_i, size_i],
+                         'best': best[pair_i, size_i],
+                         'worst': worst[pair_i, size_i],
+                         'best_aggregator': self.aggregators[best_index[pair_i, size_i]],
+                         'worst_aggregator': self.aggregators[worst_index[pair_i, size_i]]})
+        return rows
+
+
+def latest():
+    """Return the latest snapshot or None if no scan finished yet. Snapshot is shared by all bot processes."""
+    return cache_backends.current().get('spreads:latest')
+
+
+def get_top_pairs(limit):
+    """Return (base symbol, token symbol) of pools with largest liquidities."""
+    api_params = {'limit': limit,
+                  'orderBy': 'usdLiquidity',
+                  'direction': 'desc',
+                  'key': POOLS_KEY
+                  }
+    response = api_call(config.URLS['deepest'], params=api_params, cache_ttl=config.SPREAD_SCANNER['interval'])
+    pairs = []
+    for row in response['results']:
+        pair = (str(row['baseSymbol']).upper(), str(row.get('tokenSymbol') or row['tokenName']).upper())
+        if pair not in pairs:
+            pairs.append(pair)
+    return pairs
+
+
+def scan():
+    """Quote top pairs on every aggregator and store the snapshot.
+
+    Returns:
+        SpreadSnapshot: The new snapshot.
+    """
+    settings = config.SPREAD_SCANNER
+    pairs = get_top_pairs(settings['pairs'])
+    disabled = disabled_aggregators()
+    aggregators = [aggregator for aggregator in config.URLS['aggregators']
+                   if aggregator in gt.SELL_OFFER_FUNCTIONS and aggregator not in disabled]
+    sizes = settings['sizes']
+
+    def quote(pair, aggregator, size):
+        base, token = pair
+        # Aggregators name wrapped ether differently
+        if base in ('ETH', 'WETH'):
+            base = config.AGGREGATOR_PREFERENCES[aggregator]['default_token']
+        params = {'fromToken': base, 'toToken': token, 'fromAmount': float(size), 'toAmount': None}
+        try:
+            offer = gt.SELL_OFFER_FUNCTIONS[aggregator](params)
+            return offer['to_amount'] / offer['from_amount']
+        except (APIError, DataError, KeyError, ValueError, TypeError, ZeroDivisionError):
+            return np.nan
+
+    with tracing.trace('job.spread_scan', pairs=len(pairs)):
+        with ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
+            futures = [[[tracing.submit(executor, quote, pair, aggregator, size) for size in sizes]
+                        for aggregator in aggregators]
+                       for pair in pairs]
+            rates = np.array([[[future.result() for future in row] for row in matrix] for matrix in futures],
+                             dtype=float).reshape(len(pairs), len(aggregators), len(sizes))
+    snapshot = SpreadSnapshot(pairs, aggregators, sizes, rates)
+    cache_backends.current().set('spreads:latest', snapshot, settings['keep'])
+    return snapshot
+
+
+def scan_job(context=None):
+    """Job queue callback running a scan. Errors are logged so the job keeps running."""
+    snapshot = latest()
+    if snapshot and time.time() - snapshot.timestamp < config.SPREAD_SCANNER['interval'] / 2:
+        return  # Another process scanned recently
+    try:
+        snapshot = scan()
+        logger.info(f"Spread scan quoted {int((~np.isnan(snapshot.rates)).sum())}/{snapshot.rates.size} offers")
+    except Exception:
+        logger.exception("Spread scan failed")
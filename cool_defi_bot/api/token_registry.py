@@ -0,0 +1,241 @@
+"""
+Canonical token registry keyed by contract address and merged from all token sources.
+Miha Lotric, Dec 2019
+"""
+from math import inf
+import threading
+import logging
+import time
+
+from cool_defi_bot.api.custom_exceptions import DataError
+from cool_defi_bot.api.helpers import api_call, disabled_aggregators
+from cool_defi_bot import reloader
+import cool_defi_bot.config as config
+
+
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('pools', 'oneinch', 'paraswap', 'zerox')
+SOURCE_BITS = dict([(source, 1 << i) for i, source in enumerate(SOURCES)])
+
+
+class Token:
+    """Token metadata. Sources listing the token are stored as bits of `sources`, with the symbol each of them uses.
+    """
+    __slots__ = ('address', 'symbols', 'name', 'decimals', 'sources', 'positions', 'liquidity', 'pool')
+
+    def __init__(self, address):
+        self.address = address
+        self.symbols = {}  # source: SYMBOL, sources may disagree on a token's symbol
+        self.name = None
+        self.decimals = None
+        self.sources = 0
+        self.positions = {}  # source: position in the source's listing, breaks liquidity ties
+        self.liquidity = 0  # USD liquidity of the deepest pool, used to pick among tokens with the same symbol
+        self.pool = None  # Deepest pool row from pools exchanges
+
+    def listed_by(self, source):
+        """Return if the source lists this token."""
+        return bool(self.sources & SOURCE_BITS[source])
+
+    def rank(self):
+        """Return sort key of tokens sharing a symbol. Deepest liquidity first, then the order sources list them in,
+        in the order of `SOURCES`."""
+        return -self.liquidity, tuple(self.positions.get(source, inf) for source in SOURCES), self.address
+
+    def symbol(self, source=None):
+        """Return symbol used by the source, or by the first source in `SOURCES` listing the token if None."""
+        if source in self.symbols:
+            return self.symbols[source]
+        return next((self.symbols[source] for source in SOURCES if source in self.symbols), None)
+
+    def as_dict(self, source=None):
+        return {'address': self.address, 'symbol': self.symbol(source), 'name': self.name, 'decimals': self.decimals}
+
+
+def _pools_rows(response):
+    # Rows are sorted by liquidity, the first row of a token is its deepest pool
+    for row in response['results']:
+        if row.get('token') and row.get('tokenSymbol'):
+            yield row['token'], {'symbol': row['tokenSymbol'],
+                                 'name': row.get('tokenName'),
+                                 'liquidity': row.get('usdLiquidity') or 0,
+                                 'pool': row}
+
+
+def _oneinch_rows(response):
+    for symbol, data in response.items():
+        yield data['address'], {'symbol': symbol, 'name': data.get('name'), 'decimals': data['decimals']}
+
+
+def _paraswap_rows(response):
+    for data in response['tokens']:
+        yield data['address'], {'symbol': data['symbol'], 'decimals': data['decimals']}
+
+
+def _zerox_rows(response):
+    for data in response['records']:
+        yield data['address'], {'symbol': data['symbol'], 'decimals': data['decimals']}
+
+
+def _fetch(source):
+    """Return (address, token data) rows of a source."""
+    if source == 'pools':
+        response = api_call(config.URLS['pools_exchanges'], {'key': POOLS_KEY},
+                            cache_ttl=config.API_CACHE_TTL['exchanges'], hedge=True)
+        return _pools_rows(response)
+    url = config.URLS['aggregators'][source]['tokens']
+    response = api_call(url, cache_ttl=config.API_CACHE_TTL['tokens'])
+    return {'oneinch': _oneinch_rows, 'paraswap': _paraswap_rows, 'zerox': _zerox_rows}[source](response)
+
+
+class TokenRegistry:
+    """Tokens from all sources keyed by lowercase address, with symbol indexes for O(1) lookups.
+
+    Each source is refreshed when its data is older than its cache TTL. Refresh merges rows into existing tokens
+    and only rebuilds symbol index entries of symbols that changed.
+    """
+
+    def __init__(self):
+        self.tokens = {}  # address: Token
+        self._symbols = {}  # SYMBOL: set of addresses some source lists under it
+        self._index = dict([(source, {}) for source in SOURCES + (None,)])  # source: {SYMBOL: address}
+        self._refreshed = dict([(source, 0) for source in SOURCES])
+        self._lock = threading.Lock()
+
+    def merge(self, source, rows):
+        """Merge (address, token data) rows of a source into the registry."""
+        bit = SOURCE_BITS[source]
+        seen = set()
+        changed = set()
+        moved = set()  # Symbols of tokens whose position in the listing changed
+        for position, (address, data) in enumerate(rows):
+            address = address.lower()
+            if address in seen:
+                continue  # Only the first (deepest) pool row counts
+            seen.add(address)
+            symbol = str(data['symbol']).upper()
+            token = self.tokens.get(address)
+            if not token:
+                token = self.tokens[address] = Token(address)
+            if token.symbols.get(source) != symbol:
+                changed.add(self._unlist(token, source))  # Old symbol may resolve to another token now
+                token.symbols[source] = symbol
+                changed.add(symbol)
+            if data.get('liquidity', token.liquidity) != token.liquidity:
+                changed.update(token.symbols.values())  # Liquidity ranks the token under every symbol it has
+            token.sources |= bit
+            if token.positions.get(source) != position:
+                token.positions[source] = position
+                moved.add(symbol)
+            token.name = data.get('name') or token.name
+            token.decimals = data.get('decimals', token.decimals)
+            if 'liquidity' in data:
+                token.liquidity = data['liquidity']
+                token.pool = data['pool']
+            self._symbols.setdefault(symbol, set()).add(address)
+        # Tokens the source doesn't list anymore
+        for token in self.tokens.values():
+            if token.sources & bit and token.address not in seen:
+                token.sources &= ~bit
+                token.positions.pop(source, None)
+                changed.add(self._unlist(token, source))
+        # Positions matter only for symbols shared by several tokens
+        changed.update(symbol for symbol in moved if len(self._symbols.get(symbol, ())) > 1)
+        changed.discard(None)
+        for symbol in changed:
+            self._reindex(symbol)
+
+    def _unlist(self, token, source):
+        """Remove the symbol the source uses for the token and return it, None if the source didn't list it."""
+        symbol = token.symbols.pop(source, None)
+        if symbol and symbol not in token.symbols.values():
+            self._symbols.get(symbol, set()).discard(token.address)
+        return symbol
+
+    def _reindex(self, symbol):
+        """Pick the token a symbol resolves to, for every source. Tokens are ordered by `Token.rank`, so collisions
+        resolve the same way for all sources and don't depend on set order."""
+        candidates = sorted((self.tokens[address] for address in self._symbols.get(symbol, ())), key=Token.rank)
+        for source, index in self._index.items():
+            listed = [token for token in candidates
+                      if (symbol in token.symbols.values() if source is None else token.symbols.get(source) == symbol)]
+            if listed:
+                index[symbol] = listed[0].address
+            else:
+                index.pop(symbol, None)
+
+    def refresh(self, source, force=False):
+        """Fetch and merge a source if its data is stale."""
+        ttl = config.API_CACHE_TTL['exchanges' if source == 'pools' else 'tokens']
+        if not force and time.time() - self._refreshed[source] < ttl:
+            return
+        if self._refreshed[source] and not self._lock.acquire(blocking=False):
+            return  # Another thread is refreshing, stale data is good enough meanwhile
+        elif not self._refreshed[source]:
+            self._lock.acquire()  # No data yet, wait for it
+        try:
+            if force or time.time() - self._refreshed[source] >= ttl:
+                self.merge(source, _fetch(source))
+                self._refreshed[source] = time.time()
+        finally:
+            self._lock.release()
+
+    def resolve(self, symbol, source=None):
+        """Return token for a symbol, as listed by a source (or any source if None).
+
+        Raises:
+            DataError: If the source doesn't list the symbol.
+        """
+        if source:
+            self.refresh(source)
+        address = self._index[source].get(str(symbol).upper())
+        if not address:
+            raise DataError("<b>Token not found</b>\nPlease try another symbol")
+        return self.tokens[address]
+
+    def expire(self, source):
+        """Refresh source on its next use. Its current tokens are served until the refresh finishes."""
+        if self._refreshed[source]:
+            self._refreshed[source] = 1
+
+    def is_warm(self, source):
+        """Return if the source was loaded at least once."""
+        return bool(self._refreshed[source])
+
+
+REGISTRY = TokenRegistry()
+
+
+def enabled_sources():
+    """Return sources used by enabled commands, tokens of disabled aggregators aren't kept warm."""
+    disabled = disabled_aggregators()
+    return [source for source in SOURCES if source not in disabled]
+
+
+def refresh_job(context=None):
+    """Job queue callback keeping enabled sources warm, so commands and readiness checks don't wait for them."""
+    for source in enabled_sources():
+        try:
+            REGISTRY.refresh(source)
+        except Exception:
+            logger.exception(f"Refreshing {source} tokens failed")
+
+
+def _expire_changed_sources(changed):
+    """Refresh sources whose urls changed in reloaded settings."""
+    if 'URLS' not in changed:
+        return
+    old, new = changed['URLS']
+    for source in SOURCES:
+        if source == 'pools':
+            moved = old.get('pools_exchanges') != new.get('pools_exchanges')
+        else:
+            moved = old['aggregators'].get(source, {}).get('tokens') != new['aggregators'].get(source, {}).get('tokens')
+        if moved:
+            REGISTRY.expire(source)
+
+
+reloader.add_listener(_expire_changed_sources)
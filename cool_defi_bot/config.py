@@ -1,3 +1,20 @@
+from dotenv import load_dotenv
+import os
+
+
+load_dotenv()  # Load keys from .env file, modules read them from here so it's loaded only once
+BOT_TOKEN = os.getenv('BOT_TOKEN')  # Telegram bot token
+# Comma separated tokens of several bots (eg. local, staging, production) served by one process
+BOT_TOKENS = [token.strip() for token in os.getenv('BOT_TOKENS', BOT_TOKEN or '').split(',') if token.strip()]
+POOLS_KEY = os.getenv("POOLS_KEY")  # Blocklytics pools API key
+ANALYTICS_TOKEN = os.getenv("ANALYTICS_TOKEN")  # Analytics key to track usage of the bot
+SLACK_KEY = os.getenv("SLACK_KEY")  # Slack key to send developers the errors and exceptions
+PROFILING_KEY = os.getenv('PROFILING_KEY')  # Key required by profiling routes, they are disabled without it
+CONTROL_KEY = os.getenv('CONTROL_KEY')  # Key required by the settings reload route, it is disabled without it
+CACHE_BACKEND = os.getenv("CACHE_BACKEND")  # Empty for in-process cache, otherwise eg. redis://localhost:6379/0
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL")  # If set spans are posted there instead of written to file
+CASSETTE_MODE = os.getenv("CASSETTE_MODE")  # 'record' or 'replay' upstream responses, see CASSETTE
+
 EMOJIS = {
     'platforms': {
         'uniswap': '🦄',
@@ -7,8 +24,8 @@ EMOJIS = {
         'oneinch': '🏴‍☠',
         'dexag': '🍇',
         'paraswap': '🔷',
-        '0x': '⚫'
-    }
+        'zerox': '⚫'
+    }  # Keyed by aggregator names, see AGGREGATOR_COMMANDS
 }
 
 COMMANDS = ['/pools',
@@ -19,7 +36,10 @@ COMMANDS = ['/pools',
             '/1inch',
             '/dexag',
             '/paraswap',
-            '/0x'
+            '/0x',
+            '/impact',
+            '/spreads',
+            '/toppools'
             ]
 
 URLS = {
@@ -71,3 +91,135 @@ AGGREGATOR_PREFERENCES = {
         'default_token': 'WETH'
     }
 }
+
+IMPACT_PREFERENCES = {
+    'sizes': [1, 10, 100, 1000, 10000],  # Multiples of the requested amount
+    'aggregators': ['dexag', 'paraswap', 'zerox'],  # Used when user doesn't specify one
+    'max_workers': 8  # Concurrent upstream calls per command
+}
+
+DISABLED_COMMANDS = ['1inch']  # Commands without handlers, devs decided to exclude 1inch service for now
+
+AGGREGATOR_COMMANDS = {
+    'dexag': 'dexag',
+    'paraswap': 'paraswap',
+    '0x': 'zerox',
+    '1inch': 'oneinch'
+}
+
+QUOTE_CACHE = {
+    'ttl': 5,  # Seconds a quote is served from cache
+    'bucket_ratio': 1.05  # Amounts within this ratio of each other share a cached quote
+}
+
+API_CACHE_TTL = {
+    'tokens': 300,  # Aggregator token lists
+    'exchanges': 60  # Pools exchanges list
+}
+
+TELEGRAM_LIMITS = {
+    'global_rate': 30,  # Messages per second for the whole bot
+    'global_burst': 30,
+    'group_rate': 20 / 60,  # Messages per second in one group
+    'group_burst': 5,
+    'private_rate': 1,  # Messages per second in one private chat
+    'private_burst': 3,
+    'chat_action_interval': 5,  # Seconds typing status is shown
+    'max_chats': 100000,  # Chats whose buckets and last action are kept
+    'send_workers': 8  # Threads making send requests
+}
+
+PROFILING = {
+    'directory': 'profiles',  # Where profiles and memory logs are written
+    'sample_every': 100,  # Profile one in n commands
+    'max_files': 50,  # Older command profiles and memory logs are removed
+    'memory_log_bytes': 1000000,
+    'memory_frames': 10,  # Stack frames stored by tracemalloc
+    'memory_top_lines': 5  # Source lines with biggest allocations per logged block
+}
+
+TRACING = {
+    'enabled': True,
+    'file': 'traces.jsonl',  # Used when TRACE_COLLECTOR_URL isn't set
+    'file_bytes': 10000000,  # Size at which the file is rotated
+    'file_backups': 5,  # Rotated files kept, older ones are removed
+    'batch_size': 100,  # Spans are exported when a batch is full or on flush interval
+    'flush_interval': 5,
+    'max_buffer': 10000  # Spans beyond this are dropped until buffer is exported
+}
+
+EXCEPTION_REPORTS = {
+    'window': 60,  # Seconds exceptions are grouped before summaries are posted
+    'samples': 3,  # Commands and trace ids kept per group
+    'max_groups': 100,
+    'max_posts': 5  # Slack messages per window
+}
+
+DEADLINES = {
+    'command': 10,  # Seconds a command has for all upstream calls
+    'upstream_timeout': 10,  # Upper limit for a single upstream call
+    'min_call': 0.3  # Calls aren't started with less time left
+}
+
+HEDGING = {
+    'enabled': True,
+    'percentile': 95,  # Duplicate request is sent when the first one is slower than this percentile
+    'min_delay': 0.1,  # Seconds
+    'min_samples': 20,  # Endpoints with fewer recorded requests aren't hedged
+    'max_ratio': 0.05,  # Share of requests that can be hedged
+    'max_burst': 5,  # Hedges that can be saved up while upstreams are fast
+    'workers': 32  # Threads sending duplicate requests, first requests don't wait for them
+}
+
+FAIRNESS = {
+    'workers': 50,  # Threads running command handlers
+    'chat_concurrency': 3,  # Handlers one chat can run at the same time
+    'chat_queue': 20,  # Commands waiting per chat, further ones are dropped
+    'chat_rate': 1,  # Commands per second per chat
+    'chat_burst': 10,
+    'user_rate': 0.5,  # Commands per second per user
+    'user_burst': 5,
+    'collapse_window': 3,  # Seconds identical commands from a chat are answered once
+    'max_buckets': 100000
+}
+
+HTTP_POOL = {
+    'connections': 20,  # Hosts kept in the pool
+    'maxsize': 50,  # Connections per host
+    'validator_ttl': 86400  # Seconds ETag/Last-Modified and last body are kept for conditional requests
+}
+
+CASSETTE = {
+    'path': 'cassettes/upstream.jsonl.gz',  # Recorded upstream responses
+    'latency': False,  # Replayed responses take as long as recorded ones
+    'headers': ('Content-Type', 'Content-Length', 'ETag', 'Last-Modified')  # Response headers that are recorded
+}
+
+SPREAD_SCANNER = {
+    'interval': 120,  # Seconds between scans
+    'keep': 1800,  # Seconds a snapshot is served before it is considered too old
+    'pairs': 10,  # Deepest pools to scan
+    'sizes': [1, 10, 100],  # Amounts of base token
+    'max_workers': 8  # Concurrent upstream calls
+}
+
+RETURNS_TABLE = {
+    'interval': 1800,  # Seconds between refreshes
+    'keep': 7200,  # Seconds a table is served before it is considered too old
+    'pools': 100,  # Deepest pools to fetch returns for
+    'max_workers': 8  # Concurrent upstream calls
+}
+
+HEALTH = {
+    'window': 50,  # Recent requests the success rate of an upstream is computed from
+    'min_samples': 5,  # Upstreams with fewer recent requests are not judged
+    'min_success_rate': 0.5,
+    'max_success_age': 900,  # Seconds since the last successful request, upstreams are called at least by jobs
+    'max_queue': 200,  # Updates waiting in dispatcher queues and the fair scheduler
+    'max_utilization': 0.95  # Share of busy fair scheduler workers
+}
+
+RELOAD = {
+    'override_file': 'config_override.json',  # JSON object of settings merged over the ones in this file
+    'watch_interval': 5  # Seconds between checks of the override file for changes, 0 disables watching
+}
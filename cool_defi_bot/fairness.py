@@ -0,0 +1,188 @@
+"""
+Fair scheduling of command handlers across chats with throttling of abusive chats and users.
+Miha Lotric, Dec 2019
+"""
+from collections import deque
+from contextvars import copy_context
+from functools import wraps
+import threading
+import logging
+import time
+
+from cool_defi_bot import config
+from cool_defi_bot import reloader
+from cool_defi_bot.sender import TokenBucket
+from cool_defi_bot.api.deadline import budget
+
+
+logger = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """Run handlers on a pool of worker threads, taking chats in round-robin order.
+
+    Every chat has its own queue and can't occupy more than `chat_concurrency` workers. Chats and users are limited
+    by token buckets and identical commands from a chat within `collapse_window` seconds are answered only once.
+
+    Args:
+        settings [dict]: See `config.FAIRNESS`.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.metrics = {'accepted': 0, 'processed': 0, 'collapsed': 0,
+                        'throttled_chat': 0, 'throttled_user': 0, 'queue_full': 0}
+        self.busy = 0  # Workers running a handler
+        self._queues = {}  # chat_id: deque of calls
+        self._running = {}  # chat_id: number of handlers running
+        self._round = deque()  # Chats with queued calls, in the order they are served
+        self._chat_buckets = {}
+        self._user_buckets = {}
+        self._recent = {}  # (chat_id, command text): timestamp
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def submit(self, update, fun, *args, tenant=None):
+        """Queue fun(*args) for the chat of the update. Returns False if the update was dropped.
+
+        Chats of different bots sharing the scheduler are told apart by `tenant`, users are throttled across bots.
+        fun runs in a copy of the current context, so a command budget started before submitting carries over.
+        """
+        chat_id = (tenant, update.effective_chat.id) if update.effective_chat else None
+        user_id = update.effective_user.id if update.effective_user else None
+        text = ' '.join(update.effective_message.text.lower().split()) if update.effective_message else ''
+        now = time.monotonic()
+        with self._condition:
+            if not self._threads:
+                self._start()
+            # Collapse identical commands
+            self._forget_recent(now)
+            if (chat_id, text) in self._recent:
+                self.metrics['collapsed'] += 1
+                return False
+            if not self._allowed(self._chat_buckets, chat_id, 'chat', now):
+                self.metrics['throttled_chat'] += 1
+                return False
+            if not self._allowed(self._user_buckets, user_id, 'user', now):
+                self.metrics['throttled_user'] += 1
+                return False
+            queue = self._queues.setdefault(chat_id, deque())
+            if len(queue) >= self.settings['chat_queue']:
+                self.metrics['queue_full'] += 1
+                return False
+            self._recent[(chat_id, text)] = now
+            if not queue and chat_id not in self._round:
+                self._round.append(chat_id)
+            queue.append((fun, args, copy_context()))
+            self.metrics['accepted'] += 1
+            self._condition.notify()
+            return True
+
+    def set_settings(self, settings):
+        """Apply new settings. Buckets are created again with the new rates, worker threads are kept."""
+        with self._condition:
+            self.settings = settings
+            self._chat_buckets.clear()
+            self._user_buckets.clear()
+            self._condition.notify_all()  # Chats may run more handlers at once
+
+    def stats(self):
+        """Return counters, queued calls, busy workers and worker utilization."""
+        with self._condition:
+            return dict(self.metrics,
+                        queued=sum(len(queue) for queue in self._queues.values()),
+                        busy=self.busy,
+                        utilization=self.busy / self.settings['workers'])
+
+    def _allowed(self, buckets, key, kind, now):
+        if key is None:
+            return True
+        bucket = buckets.get(key)
+        if not bucket:
+            if len(buckets) >= self.settings['max_buckets']:
+                buckets.clear()  # Buckets are cheap to recreate, full ones are the same as new ones
+            bucket = buckets[key] = TokenBucket(self.settings[f'{kind}_rate'], self.settings[f'{kind}_burst'])
+        if bucket.wait_time(now):
+            return False
+        bucket.take()
+        return True
+
+    def _forget_recent(self, now):
+        window = self.settings['collapse_window']
+        while self._recent:
+            key, timestamp = next(iter(self._recent.items()))  # Dict keeps insertion order, oldest is first
+            if now - timestamp < window:
+                break
+            del self._recent[key]
+
+    def _start(self):
+        for i in range(self.settings['workers']):
+            thread = threading.Thread(target=self._work, name=f'fair-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """Return (chat_id, call) of the first chat in round that may run another handler, or None."""
+        for _ in range(len(self._round)):
+            chat_id = self._round.popleft()
+            if self._running.get(chat_id, 0) >= self.settings['chat_concurrency']:
+                self._round.append(chat_id)
+                continue
+            queue = self._queues[chat_id]
+            call = queue.popleft()
+            if queue:
+                self._round.append(chat_id)  # Chat goes to the back of the round
+            else:
+                del self._queues[chat_id]
+            return chat_id, call
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                item = self._next()
+                while not item:
+                    self._condition.wait()
+                    item = self._next()
+                chat_id, (fun, args, context) = item
+                self._running[chat_id] = self._running.get(chat_id, 0) + 1
+                self.busy += 1
+            try:
+                context.run(fun, *args)
+            except Exception:
+                logger.exception(f"Handler {fun.__name__} failed")
+            finally:
+                with self._condition:
+                    self._running[chat_id] -= 1
+                    if not self._running[chat_id]:
+                        del self._running[chat_id]
+                        if chat_id in self._queues and chat_id not in self._round:
+                            self._round.append(chat_id)
+                    self.busy -= 1
+                    self.metrics['processed'] += 1
+                    self._condition.notify_all()
+
+
+SCHEDULER = FairScheduler(config.FAIRNESS)
+
+
+def _apply_reloaded(changed):
+    """Let `SCHEDULER` use reloaded settings."""
+    if 'FAIRNESS' in changed:
+        SCHEDULER.set_settings(config.FAIRNESS)
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def fair_async(fun):
+    """Decorate a handler so it runs on `SCHEDULER` instead of the dispatcher's thread pool.
+
+    Bot id (token prefix) is the tenant, so several bots can share the scheduler. The command's budget starts when
+    the update is submitted, time spent waiting in the queue counts against it.
+    """
+    @wraps(fun)
+    def wrapper(update, context, *args):
+        with budget(config.DEADLINES['command']):
+            SCHEDULER.submit(update, fun, update, context, *args, tenant=context.bot.token.split(':')[0])
+    return wrapper
@@ -0,0 +1,61 @@
+"""
+Re-initialization of process state after fork, for gunicorn workers of a preloaded app.
+Miha Lotric, Dec 2019
+"""
+import threading
+import logging
+import sys
+
+from cool_defi_bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+def _loaded(name):
+    """Return module if it was already imported, modules that weren't have no state to reset."""
+    return sys.modules.get(f'cool_defi_bot.{name}')
+
+
+def after_fork():
+    """Replace state a forked child can't share with its parent.
+
+    Threads of the parent don't exist in the child, locks may have been held at fork time and pooled connections
+    would be shared with the parent and other workers. Cached data is kept, it is valid in every process.
+    """
+    helpers = _loaded('api.helpers')
+    if helpers:
+        helpers.SESSION = helpers.new_session()
+        helpers._stats_lock = threading.Lock()
+    hedging = _loaded('api.hedging')
+    if hedging:
+        hedging.HEDGER = hedging.Hedger(config.HEDGING)
+    cache_backends = _loaded('api.cache_backends')
+    if cache_backends and hasattr(cache_backends.current(), '_lock'):
+        cache_backends.current()._lock = threading.Lock()  # Redis clients reconnect in a new process by themselves
+    quote_cache = _loaded('api.quote_cache')
+    if quote_cache:
+        quote_cache.QUOTES._lock = threading.Lock()
+    token_registry = _loaded('api.token_registry')
+    if token_registry:
+        token_registry.REGISTRY._lock = threading.Lock()
+    profiling = _loaded('profiling')
+    if profiling:
+        profiling._lock = threading.Lock()
+    tracing = _loaded('tracing')
+    if tracing:
+        tracing.EXPORTER = tracing.SpanExporter(config.TRACING, config.TRACE_COLLECTOR_URL)
+    slack = _loaded('slack')
+    if slack:
+        slack.REPORTER = slack.ExceptionReporter(config.EXCEPTION_REPORTS)
+    sender = _loaded('sender')
+    if sender:
+        sender.SCHEDULER = sender.MessageScheduler(config.TELEGRAM_LIMITS)
+    fairness = _loaded('fairness')
+    if fairness:
+        fairness.SCHEDULER = fairness.FairScheduler(config.FAIRNESS)
+    reloader = _loaded('reloader')
+    if reloader:
+        reloader._lock = threading.Lock()
+        reloader._watcher = None  # Started again with the bots
+    logger.info("Process state re-initialized after fork")
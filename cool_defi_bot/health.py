@@ -0,0 +1,67 @@
+"""
+Liveness and readiness of the bot, from token registry warmth, upstream success and queue depths.
+Miha Lotric, Dec 2019
+"""
+from cool_defi_bot.api.token_registry import REGISTRY, enabled_sources
+from cool_defi_bot.api.helpers import fetch_health, disabled_aggregators
+from cool_defi_bot import fairness
+from cool_defi_bot import config
+
+
+def upstreams():
+    """Return health of every upstream called so far, with `ok` set to False for degraded ones.
+
+    An upstream is degraded when too many of its recent requests failed, or when it keeps failing and hasn't
+    answered for longer than `max_success_age`.
+    """
+    settings = config.HEALTH
+    report = fetch_health()
+    for endpoint, health in report.items():
+        failing_rate = health['samples'] >= settings['min_samples'] and \
+            health['success_rate'] < settings['min_success_rate']
+        # Upstreams that never answered are judged by success rate only
+        failing_long = None not in (health['last_success_age'], health['last_failure_age']) and \
+            health['last_failure_age'] < health['last_success_age'] and \
+            health['last_success_age'] > settings['max_success_age']
+        health['ok'] = not (failing_rate or failing_long)
+    return report
+
+
+def queues(dispatchers):
+    """Return updates waiting in dispatcher queues and the fair scheduler and its worker utilization."""
+    stats = fairness.SCHEDULER.stats()
+    return {'dispatcher': sum(dispatcher.update_queue.qsize() for dispatcher in dispatchers),
+            'scheduler': stats['queued'],
+            'utilization': stats['utilization']}
+
+
+def readiness(dispatchers):
+    """Return if the bot can serve commands and the report the decision was made from.
+
+    Aggregators with disabled commands aren't required, their upstreams are reported and their tokens not loaded.
+
+    Args:
+        dispatchers [list]: Dispatchers of running bots.
+    Returns:
+        tuple: Bool and dict with keys ready, failing (reasons), tokens, upstreams and queues.
+    """
+    settings = config.HEALTH
+    tokens = dict([(source, REGISTRY.is_warm(source)) for source in enabled_sources()])
+    upstream_report = upstreams()
+    queue_report = queues(dispatchers)
+    disabled_urls = tuple(url for aggregator in disabled_aggregators()
+                          for url in config.URLS['aggregators'].get(aggregator, {}).values())
+
+    failing = [f"{source} tokens not loaded" for source, warm in tokens.items() if not warm]
+    failing += [f"{endpoint} degraded" for endpoint, health in upstream_report.items()
+                if not health['ok'] and not endpoint.startswith(disabled_urls)]
+    if queue_report['dispatcher'] + queue_report['scheduler'] > settings['max_queue']:
+        failing.append("queues full")
+    if queue_report['utilization'] > settings['max_utilization']:
+        failing.append("workers busy")
+    ready = not failing
+    return ready, {'ready': ready,
+                   'failing': failing,
+                   'tokens': tokens,
+                   'upstreams': upstream_report,
+                   'queues': queue_report}
@@ -0,0 +1,150 @@
+"""
+Opt-in sampling profiler for commands and memory tracing for decoding and formatting.
+Miha Lotric, Dec 2019
+"""
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from functools import wraps
+import tracemalloc
+import itertools
+import threading
+import cProfile
+import logging
+import pstats
+import glob
+import time
+import io
+import os
+
+from cool_defi_bot import config
+from cool_defi_bot import reloader
+
+
+SETTINGS = {'enabled': False,  # Sample commands with cProfile
+            'memory': False,  # Trace allocations with tracemalloc
+            'sample_every': config.PROFILING['sample_every']
+            }
+_counter = itertools.count()
+_lock = threading.Lock()
+_memory_logger = None
+
+
+def configure(enabled=None, memory=None, sample_every=None):
+    """Change profiling settings and return them."""
+    with _lock:
+        if enabled is not None:
+            SETTINGS['enabled'] = enabled
+        if sample_every:
+            SETTINGS['sample_every'] = max(int(sample_every), 1)
+        if memory is not None:
+            SETTINGS['memory'] = memory
+            if memory and not tracemalloc.is_tracing():
+                tracemalloc.start(config.PROFILING['memory_frames'])
+            elif not memory and tracemalloc.is_tracing():
+                tracemalloc.stop()
+        return dict(SETTINGS)
+
+
+def _apply_reloaded(changed):
+    """Use the reloaded sampling rate, memory log is opened again with the new location and sizes."""
+    global _memory_logger
+    if 'PROFILING' not in changed:
+        return
+    old, new = changed['PROFILING']
+    with _lock:
+        if old['sample_every'] != new['sample_every']:
+            SETTINGS['sample_every'] = new['sample_every']
+        if _memory_logger:
+            for handler in list(_memory_logger.handlers):
+                _memory_logger.removeHandler(handler)
+                handler.close()
+            _memory_logger = None
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def _rotate(directory, pattern, keep):
+    """Remove oldest files matching the pattern so only `keep` of them remain."""
+    files = sorted(glob.glob(os.path.join(directory, pattern)), key=os.path.getmtime)
+    for path in files[:-keep]:
+        os.remove(path)
+
+
+def profile_command(fun):
+    """Decorate a command handler so every n-th call is profiled to a file when profiling is enabled."""
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        if not SETTINGS['enabled'] or next(_counter) % SETTINGS['sample_every']:
+            return fun(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fun, *args, **kwargs)
+        finally:
+            directory = config.PROFILING['directory']
+            os.makedirs(directory, exist_ok=True)
+            profile.dump_stats(os.path.join(directory, f"command-{fun.__name__}-{time.time():.6f}.prof"))
+            _rotate(directory, 'command-*.prof', config.PROFILING['max_files'])
+    return wrapper
+
+
+def _get_memory_logger():
+    global _memory_logger
+    with _lock:
+        if not _memory_logger:
+            directory = config.PROFILING['directory']
+            os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(directory, 'memory.log'),
+                                          maxBytes=config.PROFILING['memory_log_bytes'],
+                                          backupCount=config.PROFILING['max_files'])
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            _memory_logger = logging.getLogger('cool_defi_bot.memory')
+            _memory_logger.propagate = False
+            _memory_logger.addHandler(handler)
+            _memory_logger.setLevel(logging.INFO)
+        return _memory_logger
+
+
+@contextmanager
+def memory_snapshot(label):
+    """Log allocations made inside the block when memory tracing is enabled.
+
+    Args:
+        label [str]: Name of the traced block, eg. 'decode https://api.0x.org/swap/v0/tokens'.
+    """
+    if not (SETTINGS['memory'] and tracemalloc.is_tracing()):
+        yield
+        return
+    before = tracemalloc.take_snapshot()
+    yield
+    after = tracemalloc.take_snapshot()
+    differences = after.compare_to(before, 'lineno')
+    allocated = sum(stat.size_diff for stat in differences)
+    top = '; '.join(str(stat) for stat in differences[:config.PROFILING['memory_top_lines']])
+    _get_memory_logger().info(f"{label} allocated={allocated}B top: {top}")
+
+
+def memory_profiled(fun):
+    """Decorate a function so its allocations are logged when memory tracing is enabled."""
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        with memory_snapshot(fun.__name__):
+            return fun(*args, **kwargs)
+    return wrapper
+
+
+def aggregated_stats(sort_by='cumulative', limit=50):
+    """Return tuple of path to a file with stats of all stored command profiles merged and their text summary.
+
+    Returns None if there are no profiles.
+    """
+    directory = config.PROFILING['directory']
+    files = sorted(glob.glob(os.path.join(directory, 'command-*.prof')))
+    if not files:
+        return None
+    text = io.StringIO()
+    stats = pstats.Stats(*files, stream=text)
+    stats.sort_stats(sort_by).print_stats(limit)
+    path = os.path.abspath(os.path.join(directory, 'aggregated.prof'))
+    stats.dump_stats(path)
+    return path, text.getvalue()
@@ -0,0 +1,147 @@
+"""
+Reloading settings from an override file while the bot is running.
+Miha Lotric, Dec 2019
+"""
+import threading
+import logging
+import copy
+import json
+import time
+import os
+
+from cool_defi_bot import config
+
+
+logger = logging.getLogger(__name__)
+
+# Settings as written in config.py, overrides are always merged over these. Keys and tokens from .env can't be
+# reloaded, BOT_TOKENS is read from .env as well.
+DEFAULTS = dict([(name, copy.deepcopy(value)) for name, value in vars(config).items()
+                 if name.isupper() and name != 'BOT_TOKENS' and isinstance(value, (dict, list, tuple))])
+# Settings used only when the process starts, as list of their keys or None for the whole setting. Overrides changing
+# them are rejected, the running process couldn't apply them.
+RESTART_REQUIRED = {'HEDGING': ['workers'],
+                    'FAIRNESS': ['workers'],
+                    'TELEGRAM_LIMITS': ['send_workers'],
+                    'HEALTH': ['window'],
+                    'CASSETTE': None,
+                    'RELOAD': ['override_file']}
+
+_listeners = []
+_lock = threading.Lock()
+_watcher = None
+_loaded_mtime = None
+
+
+def merge(default, override):
+    """Return default updated with override. Dicts are merged recursively, None in override removes a key."""
+    if not (isinstance(default, dict) and isinstance(override, dict)):
+        return copy.deepcopy(override)
+    merged = copy.deepcopy(default)
+    for key, value in override.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = merge(default.get(key), value)
+    return merged
+
+
+def read_override(path):
+    """Return settings from the override file, empty if it doesn't exist.
+
+    Raises:
+        ValueError: If the file isn't a JSON object of known settings.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        override = json.load(file)
+    if not isinstance(override, dict):
+        raise ValueError("Override file must contain a JSON object")
+    unknown = [name for name in override if name not in DEFAULTS]
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+    return override
+
+
+def check_restart_required(changed):
+    """Raise ValueError if changed settings include ones that are used only when the process starts."""
+    fixed = []
+    for name, (old, new) in changed.items():
+        if name not in RESTART_REQUIRED:
+            continue
+        keys = RESTART_REQUIRED[name]
+        if keys is None:
+            fixed.append(name)
+        else:
+            fixed += [f"{name}.{key}" for key in keys if old.get(key) != new.get(key)]
+    if fixed:
+        raise ValueError(f"Settings require a restart: {', '.join(fixed)}")
+
+
+def add_listener(fun):
+    """Call fun(changed) after every reload that changed settings. `changed` maps names to (old, new) values."""
+    _listeners.append(fun)
+
+
+def reload(path=None):
+    """Apply defaults merged with the override file to `config`.
+
+    Each setting is replaced with a new object and all of them are replaced in one step, so code reading
+    `config.NAME[...]` sees either the old or the new settings, never a half updated mix. Modules holding objects
+    created from settings, like the hedger or the message scheduler, update them in their listeners.
+
+    Returns:
+        list: Names of settings that changed.
+    Raises:
+        ValueError: If the override file is invalid or changes settings that require a restart.
+    """
+    global _loaded_mtime
+    path = path or config.RELOAD['override_file']
+    with _lock:
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        override = read_override(path)
+        changed = {}
+        for name, default in DEFAULTS.items():
+            value = merge(default, override[name]) if name in override else copy.deepcopy(default)
+            if value != getattr(config, name):
+                changed[name] = (getattr(config, name), value)
+        check_restart_required(changed)
+        # One dict update doesn't let other threads run in between, unlike setting the attributes one by one
+        vars(config).update([(name, value) for name, (_, value) in changed.items()])
+        _loaded_mtime = mtime
+    if changed:
+        logger.info(f"Settings reloaded, changed: {', '.join(changed)}")
+        for fun in _listeners:
+            try:
+                fun(changed)
+            except Exception:
+                logger.exception(f"Reload listener {fun.__name__} failed")
+    return list(changed)
+
+
+def _watch(path):
+    global _loaded_mtime
+    while True:
+        time.sleep(config.RELOAD['watch_interval'])
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if mtime != _loaded_mtime:
+            try:
+                reload(path)
+            except (ValueError, OSError):
+                _loaded_mtime = mtime  # Broken file is reported once, not on every check
+                logger.exception("Reloading settings failed, keeping the current ones")
+
+
+def start():
+    """Apply the override file and watch it for changes, unless watch_interval is 0. Safe to call more than once."""
+    global _watcher
+    with _lock:
+        if _watcher:
+            return
+        _watcher = True
+    path = config.RELOAD['override_file']
+    reload(path)
+    if config.RELOAD['watch_interval']:
+        _watcher = threading.Thread(target=_watch, args=(path,), name='settings-watcher', daemon=True)
+        _watcher.start()
@@ -0,0 +1,235 @@
+"""
+Outbound telegram message scheduler respecting telegram rate limits.
+Miha Lotric, Dec 2019
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextvars import copy_context
+from telegram.error import RetryAfter, TelegramError
+import threading
+import logging
+import heapq
+import time
+
+from cool_defi_bot import config
+from cool_defi_bot import tracing
+from cool_defi_bot import reloader
+
+
+logger = logging.getLogger(__name__)
+
+REPLY = 0  # Direct replies to user commands
+BROADCAST = 1  # Messages nobody is waiting for, eg. alerts
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` events per second with bursts of up to `capacity` events."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def wait_time(self, now):
+        """Return seconds until a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Use one token. Call only after `wait_time` returned 0."""
+        self.tokens -= 1
+
+
+class MessageScheduler:
+    """Queue of outbound messages sent in priority order within global and per-chat limits.
+
+    Several bots can share one scheduler. Telegram applies limits per bot, so every bot gets its own global bucket,
+    chat buckets and retry after pause. When a bot is served by several processes, each of them gets an equal share of
+    the global limit. Chat limits aren't shared, a chat is always served by the same process.
+
+    Args:
+        limits [dict]: Rates and burst sizes, see `config.TELEGRAM_LIMITS`.
+        processes [int]: Number of processes sending messages of the same bots.
+    """
+
+    def __init__(self, limits, processes=1):
+        self.limits = limits
+        self.processes = processes
+        self.global_buckets = {}  # bot token: bucket
+        self.chat_buckets = {}  # (bot token, chat_id): bucket
+        self.last_chat_action = {}  # (bot token, chat_id): (action, timestamp)
+        self.paused_until = {}  # bot token: time telegram's retry after ends
+        self.metrics = {'sent': 0, 'failed': 0, 'retried': 0, 'coalesced': 0}
+        self.latencies = dict([(priority, deque(maxlen=1000)) for priority in (REPLY, BROADCAST)])
+        self._ready = []  # Heap of (priority, sequence, message)
+        self._delayed = []  # Heap of (ready time, priority, sequence, message)
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=limits['send_workers'])
+        self._thread = None
+
+    def send_message(self, bot, priority=REPLY, **kwargs):
+        """Schedule `bot.send_message` with the keyword arguments."""
+        self._put(priority, (bot.send_message, kwargs), bot.token)
+
+    def send_chat_action(self, bot, chat_id, action):
+        """Schedule `bot.send_chat_action`. Repeated actions within their display time are skipped."""
+        now = time.monotonic()
+        with self._condition:
+            last = self.last_chat_action.get((bot.token, chat_id))
+            if last and last[0] == action and now - last[1] < self.limits['chat_action_interval']:
+                self.metrics['coalesced'] += 1
+                return
+            if not last and len(self.last_chat_action) >= self.limits['max_chats']:
+                self._forget_chats(now)
+            self.last_chat_action[(bot.token, chat_id)] = (action, now)
+        self._put(REPLY, (bot.send_chat_action, {'chat_id': chat_id, 'action': action}), bot.token)
+
+    def stats(self):
+        """Return counters, queue length and queue latency per priority."""
+        with self._condition:
+            stats = dict(self.metrics, queued=len(self._ready) + len(self._delayed))
+            for priority, name in ((REPLY, 'reply'), (BROADCAST, 'broadcast')):
+                latencies = sorted(self.latencies[priority])
+                stats[f'{name}_latency_avg'] = sum(latencies) / len(latencies) if latencies else 0
+                stats[f'{name}_latency_p95'] = latencies[int(len(latencies) * 0.95)] if latencies else 0
+            return stats
+
+    def set_limits(self, limits, processes=None):
+        """Apply new limits or number of processes. Buckets are created again with the new rates, sending threads are
+        kept."""
+        with self._condition:
+            self.limits = limits
+            self.processes = processes or self.processes
+            self.global_buckets.clear()
+            self.chat_buckets.clear()
+
+    def _put(self, priority, call, token, message=None):
+        with self._condition:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='message-scheduler', daemon=True)
+                self._thread.start()
+            if not message:
+                self._sequence += 1
+                message = {'call': call,
+                           'token': token,  # Bot the limits apply to
+                           'enqueued': time.monotonic(),
+                           'sequence': self._sequence,
+                           'context': copy_context()  # Sending is traced as part of the command
+                           }
+            # Retried messages keep their place in the queue
+            heapq.heappush(self._ready, (priority, message['sequence'], message))
+            self._condition.notify()
+
+    def _global_bucket(self, token):
+        bucket = self.global_buckets.get(token)
+        if not bucket:
+            bucket = self.global_buckets[token] = TokenBucket(self.limits['global_rate'] / self.processes,
+                                                              max(self.limits['global_burst'] / self.processes, 1))
+        return bucket
+
+    def _chat_bucket(self, token, chat_id, now):
+        bucket = self.chat_buckets.get((token, chat_id))
+        if not bucket:
+            if len(self.chat_buckets) >= self.limits['max_chats']:
+                self._forget_chats(now)
+            # Group chats have negative ids and stricter limits, channels given by username ('@channel') too
+            kind = 'private' if str(chat_id).isdigit() else 'group'
+            bucket = TokenBucket(self.limits[f'{kind}_rate'], self.limits[f'{kind}_burst'])
+            self.chat_buckets[(token, chat_id)] = bucket
+        return bucket
+
+    def _forget_chats(self, now):
+        """Drop state of chats that is the same as new, full buckets and chat actions no longer shown. If that doesn't
+        free enough, all of it is dropped like `FairScheduler` does."""
+        for key, bucket in list(self.chat_buckets.items()):
+            if not bucket.wait_time(now) and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[key]
+        for key, (_, timestamp) in list(self.last_chat_action.items()):
+            if now - timestamp >= self.limits['chat_action_interval']:
+                del self.last_chat_action[key]
+        # Dropping all when mostly active chats are left, so sweeps don't repeat for every new chat
+        if len(self.chat_buckets) >= self.limits['max_chats'] * 0.9:
+            self.chat_buckets.clear()
+        if len(self.last_chat_action) >= self.limits['max_chats'] * 0.9:
+            self.last_chat_action.clear()
+
+    def _run(self):
+        while True:
+            try:
+                self._dispatch_next()
+            except Exception:
+                # A message that can't be scheduled is dropped, the thread keeps serving the others
+                logger.exception("Scheduling message failed, message dropped")
+                self._count('failed')
+
+    def _dispatch_next(self):
+        """Hand the next message whose limits allow it to a sending thread, or wait for one."""
+        with self._condition:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._delayed)[1:])
+            if not self._ready:
+                # Sleep until something is ready or the next delayed message
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+                return
+            priority, sequence, message = heapq.heappop(self._ready)
+            token = message['token']
+            chat_bucket = self._chat_bucket(token, message['call'][1]['chat_id'], now)
+            # Wait for telegram's retry after to end, then for the bot's and the chat's limits
+            wait = max(self.paused_until.get(token, 0) - now, 0)
+            if not wait:
+                wait = self._global_bucket(token).wait_time(now) or chat_bucket.wait_time(now)
+            if wait:
+                # Other bots and chats can be served while this one waits
+                heapq.heappush(self._delayed, (now + wait, priority, sequence, message))
+                return
+            self._global_bucket(token).take()
+            chat_bucket.take()
+            self.latencies[priority].append(now - message['enqueued'])
+        self._executor.submit(message['context'].copy().run, self._send, priority, message, now)
+
+    def _send(self, priority, message, dequeued):
+        fun, kwargs = message['call']
+        try:
+            with tracing.span(f"telegram.{fun.__name__}", queue_ms=(dequeued - message['enqueued']) * 1000):
+                fun(**kwargs)
+            self._count('sent')
+        except RetryAfter as e:
+            logger.warning(f"Telegram asked to retry after {e.retry_after}s")
+            with self._condition:
+                token = message['token']
+                self.paused_until[token] = max(self.paused_until.get(token, 0), time.monotonic() + e.retry_after)
+                self.metrics['retried'] += 1
+            self._put(priority, message['call'], message['token'], message)
+        except TelegramError as e:
+            logger.warning(f"Sending message failed: {e}")
+            self._count('failed')
+
+    def _count(self, metric):
+        with self._condition:
+            self.metrics[metric] += 1
+
+
+SCHEDULER = MessageScheduler(config.TELEGRAM_LIMITS)
+
+
+def _apply_reloaded(changed):
+    """Let `SCHEDULER` use reloaded limits."""
+    if 'TELEGRAM_LIMITS' in changed:
+        SCHEDULER.set_limits(config.TELEGRAM_LIMITS)
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def send_message(bot, priority=REPLY, **kwargs):
+    """Schedule a message to be sent with `SCHEDULER`."""
+    SCHEDULER.send_message(bot, priority, **kwargs)
+
+
+def send_chat_action(bot, chat_id, action):
+    """Schedule a chat action to be sent with `SCHEDULER`."""
+    SCHEDULER.send_chat_action(bot, chat_id, action)
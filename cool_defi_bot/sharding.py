@@ -0,0 +1,113 @@
+"""
+Running the bot as several worker processes fed from a single polling process.
+Miha Lotric, Dec 2019
+"""
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher, JobQueue
+from queue import Queue
+import multiprocessing
+import threading
+import logging
+import json
+import time
+
+from cool_defi_bot import telegram_bot
+from cool_defi_bot.api import cache_backends
+from cool_defi_bot import reloader
+from cool_defi_bot import sender
+from cool_defi_bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(update, shards):
+    """Return index of the worker that handles an update. All updates of one chat go to the same worker."""
+    chat = update.effective_chat
+    return (chat.id if chat else update.update_id) % shards
+
+
+def run_worker(updates, backend, workers, shared_jobs, processes):
+    """Process updates from a multiprocessing queue with a dispatcher of this process.
+
+    Args:
+        updates [multiprocessing.Queue]: JSON-encoded updates. None stops the worker.
+        backend: Cache backend shared with other processes.
+        workers [int]: Number of dispatcher threads in this process.
+        shared_jobs [bool]: Run jobs storing their results in the backend. Only one worker does, other workers
+                            would repeat its upstream calls.
+        processes [int]: Number of worker processes, they share telegram's global limit equally.
+    """
+    cache_backends.use(backend)
+    reloader.start()
+    sender.SCHEDULER.set_limits(config.TELEGRAM_LIMITS, processes)
+    bot = Bot(telegram_bot.TOKEN)
+    dispatcher = Dispatcher(bot, Queue(), workers=workers, use_context=True)
+    telegram_bot.add_handlers(dispatcher)
+    job_queue = JobQueue()
+    job_queue.set_dispatcher(dispatcher)
+    telegram_bot.add_jobs(job_queue, shared=shared_jobs)
+    job_queue.start()
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    thread.start()
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(json.loads(data), bot))
+    job_queue.stop()
+    dispatcher.stop()
+    thread.join()
+
+
+def run_sharded(processes, workers=10, poll_timeout=10):
+    """Poll telegram in this process and fan updates out to worker processes.
+
+    Unless `CACHE_BACKEND` is set, caches are shared through a `multiprocessing.Manager` dict, so workers don't
+    repeat each other's upstream calls.
+
+    Args:
+        processes [int]: Number of worker processes.
+        workers [int]: Number of dispatcher threads per worker process.
+        poll_timeout [int]: Long polling timeout in seconds.
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    manager = None
+    if cache_backends.CACHE_BACKEND:
+        backend = cache_backends.current()
+    else:
+        manager = multiprocessing.Manager()
+        backend = cache_backends.SharedDictBackend(manager.dict())
+
+    queues = [multiprocessing.Queue() for _ in range(processes)]
+    children = [multiprocessing.Process(target=run_worker, args=(queue, backend, workers, i == 0, processes),
+                                        name=f'shard-{i}')
+                for i, queue in enumerate(queues)]
+    for child in children:
+        child.start()
+    logger.info(f"Started {processes} bot shards")
+
+    bot = Bot(telegram_bot.TOKEN)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, timeout=poll_timeout)
+            except TelegramError as e:
+                logger.warning(f"Polling failed: {e}")
+                time.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                queues[shard_for(update, processes)].put(update.to_json())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for child in children:
+            child.join()
+        if manager:
+            manager.shutdown()
@@ -0,0 +1,146 @@
+"""
+Posting to Slack and grouped exception reports.
+Miha Lotric, Dec 2019
+"""
+from collections import OrderedDict
+import threading
+import requests
+import logging
+import hashlib
+import time
+import re
+import os
+
+from cool_defi_bot import config
+from cool_defi_bot import reloader
+
+
+SLACK_KEY = config.SLACK_KEY  # Slack key to send developers the errors and exceptions
+
+logger = logging.getLogger(__name__)
+
+
+def post_message(text, channel='dev-telegram-bot', icon_emoji=':blocky-sweat:', username='Cool Defi Bot'):
+    """Post a message to a Slack channel."""
+    params = {'token': SLACK_KEY,
+              'channel': channel,
+              'text': text,
+              'icon_emoji': icon_emoji,
+              'username': username,
+              'pretty': 1
+              }
+    url = config.URLS['slack_api']
+    requests.get(url, params=params, timeout=10)
+
+
+def exception_line(error_msg):
+    """Return the `Type: message` line of a formatted traceback, messages can span several lines."""
+    lines = re.findall(r'^\w[\w.]*:.*$', error_msg, re.MULTILINE)
+    return lines[-1] if lines else ''
+
+
+def fingerprint(error_msg, exception_type=None):
+    """Return fingerprint of a formatted traceback made from exception type and functions on the stack.
+
+    Line numbers and exception messages are left out, so the same failure with different data is grouped together.
+
+    Args:
+        error_msg [str]: Formatted traceback.
+        exception_type [str]: Qualified name of the exception class, parsed from the traceback if not given.
+    """
+    frames = re.findall(r'File "([^"]+)", line \d+, in (\S+)', error_msg)
+    if exception_type is None:
+        exception_type = exception_line(error_msg).split(':')[0]
+    stack = '|'.join(f"{os.path.basename(path)}:{fun}" for path, fun in frames)
+    return hashlib.sha1(f"{exception_type}|{stack}".encode()).hexdigest()[:12]
+
+
+class ExceptionReporter:
+    """Group exceptions by fingerprint and post one summary per group to Slack each time window.
+
+    Args:
+        settings [dict]: See `config.EXCEPTION_REPORTS`.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.dropped = 0
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, command, error_msg, trace_id=None, exception_type=None):
+        """Record an exception. It is reported at the end of the current window."""
+        now = time.time()
+        key = fingerprint(error_msg, exception_type)
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='exception-reporter', daemon=True)
+                self._thread.start()
+            group = self._groups.get(key)
+            if not group:
+                if len(self._groups) >= self.settings['max_groups']:
+                    self.dropped += 1
+                    return
+                group = {'exception': exception_line(error_msg),
+                         'traceback': error_msg,
+                         'count': 0,
+                         'first_seen': now,
+                         'commands': [],
+                         'trace_ids': []}
+                self._groups[key] = group
+            group['count'] += 1
+            group['last_seen'] = now
+            if len(group['commands']) < self.settings['samples']:
+                group['commands'].append(command)
+                group['trace_ids'].append(trace_id)
+
+    def _run(self):
+        while True:
+            time.sleep(self.settings['window'])
+            self.flush()
+
+    def flush(self):
+        """Post summaries of exceptions recorded since the last flush."""
+        with self._lock:
+            groups, self._groups = self._groups, OrderedDict()
+            dropped, self.dropped = self.dropped, 0
+        for i, (key, group) in enumerate(groups.items()):
+            if i == self.settings['max_posts']:
+                # Keep Slack from throttling us, remaining groups are only counted
+                rest = list(groups.values())[i:]
+                self._post(f"*…and {len(rest)} more error groups* ({sum(g['count'] for g in rest)} errors)")
+                break
+            self._post(self.format_group(key, group))
+        if dropped:
+            self._post(f"*{dropped} errors were not grouped*, too many distinct errors")
+
+    @staticmethod
+    def format_group(key, group):
+        """Return Slack message for an exception group."""
+        time_format = '%H:%M:%S'
+        samples = '\n'.join(f"`{command}` trace `{trace_id}`"
+                            for command, trace_id in zip(group['commands'], group['trace_ids']))
+        return f"*Beep-Bop, error found!* ×{group['count']} `{key}`\n" \
+               f"First seen {time.strftime(time_format, time.gmtime(group['first_seen']))}, " \
+               f"last seen {time.strftime(time_format, time.gmtime(group['last_seen']))} UTC\n" \
+               f"{samples}\n" \
+               f"```{group['traceback']}```"
+
+    def _post(self, text):
+        try:
+            post_message(text)
+        except requests.RequestException as e:
+            logger.warning(f"Posting exception report failed: {e}")
+
+
+REPORTER = ExceptionReporter(config.EXCEPTION_REPORTS)
+
+
+def _apply_reloaded(changed):
+    """Let `REPORTER` use reloaded settings, from the next window on."""
+    if 'EXCEPTION_REPORTS' in changed:
+        REPORTER.settings = config.EXCEPTION_REPORTS
+
+
+reloader.add_listener(_apply_reloaded)
@@ -4,27 +4,34 @@ Miha Lotric, Dec 2019
 """
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ChatAction
 from telegram.ext import CommandHandler, Updater
-from telegram.ext.dispatcher import run_async
-from dotenv import load_dotenv
+from telegram.ext.dispatcher import DEFAULT_GROUP
 import requests
-import os
 import traceback
 import logging
 
-from cool_defi_bot.api.custom_exceptions import APIError, DataError, FormatError
+from cool_defi_bot.api.custom_exceptions import APIError, DataError, FormatError, DeadlineExceeded
 from cool_defi_bot.api import api_handlers
+from cool_defi_bot.api import spread_scanner
+from cool_defi_bot.api import returns_table
+from cool_defi_bot.api import token_registry
 from cool_defi_bot import config
+from cool_defi_bot import sender
+from cool_defi_bot import slack
+from cool_defi_bot.profiling import profile_command
+from cool_defi_bot.fairness import fair_async
+from cool_defi_bot import tracing
+from cool_defi_bot import reloader
+from cool_defi_bot.api.deadline import budgeted
 try:
     from private import private_features
 except ModuleNotFoundError:
     private_features = None
 
 
-load_dotenv()  # Load keys from .env file
-TOKEN = os.getenv('BOT_TOKEN')  # Telegram bot token
-SLACK_KEY = os.getenv("SLACK_KEY")  # Slack key to send developers the errors and exceptions
-POOLS_KEY = os.getenv("POOLS_KEY")  # Blocklytics pools API key
-ANALYTICS_TOKEN = os.getenv("ANALYTICS_TOKEN")  # Analytics key to track usage of the bot
+TOKEN = config.BOT_TOKEN  # Telegram bot token
+TOKENS = config.BOT_TOKENS  # Tokens of all bots served by this process
+POOLS_KEY = config.POOLS_KEY  # Blocklytics pools API key
+ANALYTICS_TOKEN = config.ANALYTICS_TOKEN  # Analytics key to track usage of the bot
 
 # TODO config file + automate the formatting
 welcome_text = """
@@ -32,9 +39,12 @@ welcome_text = """
 Get started:
 <code>/pools dai</code>
 <code>/deepest</code>
+<code>/toppools</code>
 <code>/dexag dai</code>
 <code>/paraswap dai</code>
 <code>/0x</code>
+<code>/impact dai mkr</code>
+<code>/spreads</code>
 <code>/feedback</code>
 <code>/help</code>
 """
@@ -44,6 +54,8 @@ See returns for Uniswap pools
 <code>/pools DAI</code>\n
 See the five deepest liquidity pools
 <code>/deepest</code>\n
+See the deepest pools with best returns
+<code>/toppools 30</code>\n
 See the best <a href="https://dex.ag">dex.ag</a> prices
 <code>/dexag DAI</code>
 <code>/dexag 500 DAI</code>
@@ -58,39 +70,52 @@ See the best <a href="https://0x.org">0x</a> prices
 <code>/0x 500 DAI</code>
 <code>/0x 500 DAI MKR</code>
 <code>/0x ETH 1 MKR</code>\n
+See how price changes with order size
+<code>/impact DAI MKR</code>
+<code>/impact 100 DAI MKR</code>
+<code>/impact 0x 100 DAI MKR</code>\n
+See where aggregators disagree the most
+<code>/spreads</code>\n
 Submit feedback 
 <code>/feedback {your feedback}</code>
 """
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
 def start(update, context):
     """Send the user welcome message and possible commands."""
-    context.bot.send_message(chat_id=update.effective_chat.id, 
-                             text=welcome_text, 
-                             parse_mode=ParseMode.HTML)
+    sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                        text=welcome_text,
+                        parse_mode=ParseMode.HTML)
     # We use `effective_message` instead of `message` to handle situations when the
     # original message is deleted or edited - same for `effective_chat`
-    post_analytics(update.effective_message)
+    post_analytics(update.effective_message, context.bot)
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
 def help_(update, context):
     """Send user examples of commands."""
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=help_text, 
-                             parse_mode=ParseMode.HTML, 
-                             disable_web_page_preview=True)
-    post_analytics(update.effective_message)
+    sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                        text=help_text,
+                        parse_mode=ParseMode.HTML,
+                        disable_web_page_preview=True)
+    post_analytics(update.effective_message, context.bot)
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
+@budgeted('command')
 def pools(update, context):
     """Send user annualized returns for requested token."""
     # Jumping dots animation indicating that bot is writing a response
-    context.bot.sendChatAction(chat_id=update.effective_message.chat_id, 
-                               action=ChatAction.TYPING)
-    error_msg = pass_exception = None
+    sender.send_chat_action(context.bot, chat_id=update.effective_message.chat_id,
+                            action=ChatAction.TYPING)
+    error_msg = exception_type = pass_exception = None
     # Calling module for formatted data and token address
     try:
         response, address = api_handlers.get_pool(list(context.args))
@@ -99,27 +124,31 @@ def pools(update, context):
         button = InlineKeyboardMarkup(keyboard)
     except Exception as e:
         error_msg = traceback.format_exc()  # Get full error message
+        exception_type = type(e).__qualname__
         pass_exception, response = check_exceptions(e)  # Respond appropriately depending on exception
         button = None
     finally:
         # Sending the message
-        context.bot.send_message(chat_id=update.effective_chat.id, 
-                                 text=response, 
-                                 reply_markup=button, 
-                                 parse_mode=ParseMode.HTML, 
-                                 disable_web_page_preview=True)
-        post_analytics(update['message'])
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            reply_markup=button,
+                            parse_mode=ParseMode.HTML,
+                            disable_web_page_preview=True)
+        post_analytics(update['message'], context.bot)
         if pass_exception:
-            send_exception(update['message'].text, error_msg)  # Send exception to Slack
+            send_exception(update['message'].text, error_msg, exception_type)  # Send exception to Slack
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
+@budgeted('command')
 def deepest(update, context):
     """Send user 5 tokens with biggest liquidities."""
     # Jumping dots animation indicating that bot is writing a response
-    context.bot.sendChatAction(chat_id=update.effective_message.chat_id, 
-                               action=ChatAction.TYPING)
-    error_msg = pass_exception = None
+    sender.send_chat_action(context.bot, chat_id=update.effective_message.chat_id,
+                            action=ChatAction.TYPING)
+    error_msg = exception_type = pass_exception = None
     # Calling module for formatted data and token address
     try:
         response = api_handlers.get_deepest()
@@ -129,25 +158,29 @@ def deepest(update, context):
         button = InlineKeyboardMarkup(keyboard)
     except Exception as e:
         error_msg = traceback.format_exc()
+        exception_type = type(e).__qualname__
         pass_exception, response = check_exceptions(e)
         button = None
     finally:
         # Sending the message
-        context.bot.send_message(chat_id=update.effective_chat.id, 
-                                 text=response, 
-                                 parse_mode=ParseMode.HTML,
-                                 reply_markup=button)
-        post_analytics(update['message'])
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=button)
+        post_analytics(update['message'], context.bot)
         if pass_exception:
-            send_exception(update['message'].text, error_msg)
+            send_exception(update['message'].text, error_msg, exception_type)
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
+@budgeted('command')
 def aggregator_offer(update, context, aggregator):
     # Jumping dots animation indicating that bot is writing a response
-    context.bot.sendChatAction(chat_id=update.effective_message.chat_id, 
-                               action=ChatAction.TYPING)
-    error_msg = pass_exception = None
+    sender.send_chat_action(context.bot, chat_id=update.effective_message.chat_id,
+                            action=ChatAction.TYPING)
+    error_msg = exception_type = pass_exception = None
     # Calling module for formatted data and token address
     try:
         response = api_handlers.get_aggregator_offer(list(context.args), aggregator)
@@ -158,20 +191,99 @@ def aggregator_offer(update, context, aggregator):
         button = InlineKeyboardMarkup(keyboard)
     except Exception as e:
         error_msg = traceback.format_exc()
+        exception_type = type(e).__qualname__
         pass_exception, response = check_exceptions(e)
         button = None
     finally:
         # Sending the message
-        context.bot.send_message(chat_id=update.effective_chat.id, 
-                                 text=response, 
-                                 parse_mode=ParseMode.HTML,
-                                 reply_markup=button)
-        post_analytics(update['message'])
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=button)
+        post_analytics(update['message'], context.bot)
         if pass_exception:
-            send_exception(update['message'].text, error_msg)
+            send_exception(update['message'].text, error_msg, exception_type)
 
 
-@run_async
+@fair_async
+@profile_command
+@tracing.trace_command
+@budgeted('command')
+def impact(update, context):
+    """Send user effective rates and price impact for increasing order sizes."""
+    # Jumping dots animation indicating that bot is writing a response
+    sender.send_chat_action(context.bot, chat_id=update.effective_message.chat_id,
+                            action=ChatAction.TYPING)
+    error_msg = exception_type = pass_exception = None
+    try:
+        response = api_handlers.get_price_impact(list(context.args))
+    except Exception as e:
+        error_msg = traceback.format_exc()
+        exception_type = type(e).__qualname__
+        pass_exception, response = check_exceptions(e)
+    finally:
+        # Sending the message
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            parse_mode=ParseMode.HTML)
+        post_analytics(update['message'], context.bot)
+        if pass_exception:
+            send_exception(update['message'].text, error_msg, exception_type)
+
+
+@fair_async
+@profile_command
+@tracing.trace_command
+def spreads(update, context):
+    """Send user largest price differences between aggregators."""
+    error_msg = exception_type = pass_exception = None
+    try:
+        response = api_handlers.get_spreads(list(context.args))
+    except Exception as e:
+        error_msg = traceback.format_exc()
+        exception_type = type(e).__qualname__
+        pass_exception, response = check_exceptions(e)
+    finally:
+        # Sending the message
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            parse_mode=ParseMode.HTML)
+        post_analytics(update['message'], context.bot)
+        if pass_exception:
+            send_exception(update['message'].text, error_msg, exception_type)
+
+
+@fair_async
+@profile_command
+@tracing.trace_command
+def toppools(update, context):
+    """Send user deepest pools ranked by annualized returns."""
+    error_msg = exception_type = pass_exception = None
+    try:
+        response = api_handlers.get_top_pools(list(context.args))
+        # Button with URL redirect below the message
+        keyboard = [[InlineKeyboardButton(text="pools.fyi",
+                                          url=config.URLS['pools_site'])]]
+        button = InlineKeyboardMarkup(keyboard)
+    except Exception as e:
+        error_msg = traceback.format_exc()
+        exception_type = type(e).__qualname__
+        pass_exception, response = check_exceptions(e)
+        button = None
+    finally:
+        # Sending the message
+        sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                            text=response,
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=button)
+        post_analytics(update['message'], context.bot)
+        if pass_exception:
+            send_exception(update['message'].text, error_msg, exception_type)
+
+
+@fair_async
+@profile_command
+@tracing.trace_command
 def feedback(update, context):
     """Send user feedback to slack telegram-bot chat-room."""
     response1 = "<b>Sent</b>\nThank you for your feedback!"
@@ -185,58 +297,37 @@ def feedback(update, context):
     feedback_msg = update.effective_message['text'].lstrip('/feedback ')
     # Sending a response
     response = response1 if not empty else response2
-    context.bot.send_message(chat_id=update.effective_chat.id, 
-                             text=response, 
-                             parse_mode=ParseMode.HTML)
-    post_analytics(update.effective_message)
+    sender.send_message(context.bot, chat_id=update.effective_chat.id,
+                        text=response,
+                        parse_mode=ParseMode.HTML)
+    post_analytics(update.effective_message, context.bot)
     final_msg = f"*Feedback from user {user}(@{username})*\n" \
                 f"From chat: {chat_id} - " \
                 f"({chat_type} {'' if chat_type == 'private' else update.effective_message['chat']['title']})\n" \
                 f"> {feedback_msg}"
-    # Sending a slack message to the telegram-bot chat-room
-    params = {'token': SLACK_KEY,
-              'channel': 'telegram-bot',
-              'text': final_msg,
-              'icon_emoji': ':blocky-thinking:',
-              'username': 'telegram_bot',
-              'pretty': 1}
-    url = config.URLS['slack_api']
-    # Send message only if it contains something
+    # Sending a slack message to the telegram-bot chat-room, only if it contains something
     if not empty:
-        requests.get(url, params=params)
+        slack.post_message(final_msg, channel='telegram-bot', icon_emoji=':blocky-thinking:', username='telegram_bot')
 
 
-# todo make slack helper function
-def send_exception(command, error_msg):
-    """Send exception to slack telegram-bot chat-room."""
+def send_exception(command, error_msg, exception_type=None):
+    """Queue exception to be reported to slack dev-telegram-bot chat-room, grouped with the same exceptions."""
     print(error_msg)
-    final_msg = f"*Beep-Bop, error found!*\n" \
-                f"`{command}`\n" \
-                f"```{error_msg}```"
-    # Sending an error response to the slack telegram-bot chat-room
-    params = {'token': SLACK_KEY,
-              'channel': 'dev-telegram-bot',
-              'text': final_msg,
-              'icon_emoji': ':blocky-sweat:',
-              'username': 'Cool Defi Bot',
-              'pretty': 1
-              }
-    url = config.URLS['slack_api']
-    requests.get(url, params=params)
+    slack.REPORTER.add(command, error_msg, tracing.current_trace_id(), exception_type)
 
 
 def check_exceptions(exception):
     """Returns exception response and if it should be passed to devs, depending on type of exception."""
     if type(exception) in (DataError, FormatError):
         return False, str(exception)
-    elif type(exception) == APIError:
+    elif type(exception) in (APIError, DeadlineExceeded):
         return True, str(exception)
     else:
         return True, "<b>There has been an error, sorry for inconvenience.</b>\nError was sent to devs."
 
 
-def post_analytics(msg):
-    """Pass message info to google analytics."""
+def post_analytics(msg, bot):
+    """Pass message info to google analytics, labelled with the bot that received it."""
     sender = msg.from_user
     chat = msg.chat
     # Apply to your own bot tokens
@@ -259,7 +350,7 @@ def post_analytics(msg):
                     't': 'event',  # Hit type
                     'ec': 'bot command',  # type of command
                     'ea': command.lstrip('/'),  # command (eg. dexag)
-                    'ds': bot_type.get(TOKEN[-4:], 'Unknown')  # local/staging/production bot
+                    'ds': bot_type.get(bot.token[-4:], 'Unknown')  # local/staging/production bot
                     }
     # *senderId is a unique number indicating a user or a group. Bot uses it to send messages to the user/group and the
     # easiest way to find your id is with @jsondumpbot. We collect ids to track how many unique users there are.
@@ -268,15 +359,8 @@ def post_analytics(msg):
     requests.post(url, params_event)
 
 
-def get_bot():
-    """Create and return telegram bot instance."""
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        level=logging.INFO)
-
-    # Create a bot instance
-    updater = Updater(token=TOKEN, use_context=True, workers=50)
-    dispatcher = updater.dispatcher
-
+def get_handlers():
+    """Return public and private command handlers, without the ones disabled in config."""
     # Setting funs to pass argument to the handler's callback function
     def dexag(update, context): aggregator_offer(update, context, 'dexag')
     def paraswap(update, context): aggregator_offer(update, context, 'paraswap')
@@ -290,15 +374,85 @@ def get_bot():
         ('pools', pools),
         ('deepest', deepest),
         ('dexag', dexag),
-        # ('1inch', oneinch),  # Devs decided to exclude 1inch service for now
+        ('1inch', oneinch),
         ('paraswap', paraswap),
         ('0x', zerox),
+        ('impact', impact),
+        ('spreads', spreads),
+        ('toppools', toppools),
         ('feedback', feedback)
     ]
     # Set handlers
-    handlers = [CommandHandler(*pair) for pair in (public_pairs + private_pairs)]
-    # Add handlers
-    for handler in handlers:
+    return [CommandHandler(*pair) for pair in (public_pairs + private_pairs)
+            if pair[0] not in config.DISABLED_COMMANDS]
+
+
+def add_handlers(dispatcher):
+    """Add command handlers to a dispatcher and replace them whenever settings are reloaded."""
+    for handler in get_handlers():
         dispatcher.add_handler(handler)
+    reloader.add_listener(lambda changed: swap_handlers(dispatcher))
+
+
+def swap_handlers(dispatcher):
+    """Replace command handlers of a dispatcher in one step, updates being processed finish with the old ones."""
+    dispatcher.handlers[DEFAULT_GROUP] = get_handlers()
+    if DEFAULT_GROUP not in dispatcher.groups:
+        dispatcher.groups = sorted(dispatcher.groups + [DEFAULT_GROUP])
+
+
+def add_jobs(job_queue, shared=True):
+    """Schedule background jobs refreshing precomputed data.
+
+    Intervals follow reloaded settings.
+
+    Args:
+        job_queue [JobQueue]: Queue the jobs are added to.
+        shared [bool]: Also schedule jobs whose results are stored in the cache backend. Processes sharing a backend
+                       need them only in one of them. The token registry is kept in every process.
+    """
+    intervals = [(token_registry.refresh_job, lambda: config.API_CACHE_TTL['exchanges'])]
+    if shared:
+        intervals += [(spread_scanner.scan_job, lambda: config.SPREAD_SCANNER['interval']),
+                      (returns_table.refresh_job, lambda: config.RETURNS_TABLE['interval'])]
+    jobs = [(job_queue.run_repeating(callback, interval=interval(), first=0), interval)
+            for callback, interval in intervals]
+    reloader.add_listener(lambda changed: update_intervals(jobs))
+
+
+def update_intervals(jobs):
+    """Set intervals of (job, interval function) pairs from reloaded settings, they apply after the next run."""
+    for job, interval in jobs:
+        job.interval = interval()
+
+
+def get_bot(token=None, jobs=True):
+    """Create and return telegram bot instance.
+
+    Args:
+        token [str]: Telegram bot token, `TOKEN` by default.
+        jobs [bool]: Schedule background jobs on the bot's job queue.
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    # Create a bot instance
+    updater = Updater(token=token or TOKEN, use_context=True, workers=50)
+    add_handlers(updater.dispatcher)
+    if jobs:
+        add_jobs(updater.job_queue)
 
     return updater
+
+
+def get_bots(tokens=None):
+    """Create and return telegram bot instances for several tokens, served by this process.
+
+    Bots share caches, connection pools, the message scheduler and the fair scheduler, so they cost little more than
+    one bot. Background jobs are scheduled only once, their results are shared as well.
+
+    Args:
+        tokens [list]: Telegram bot tokens, `TOKENS` by default.
+    """
+    reloader.start()  # Settings from the override file apply to all bots
+    return [get_bot(token, jobs=i == 0) for i, token in enumerate(tokens or TOKENS)]
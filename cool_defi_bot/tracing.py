@@ -0,0 +1,170 @@
+"""
+Lightweight request-scoped tracing with spans exported in batches.
+Miha Lotric, Dec 2019
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from logging.handlers import RotatingFileHandler
+from functools import wraps
+import threading
+import requests
+import logging
+import json
+import time
+import uuid
+
+from cool_defi_bot import config
+from cool_defi_bot import reloader
+
+
+TRACE_COLLECTOR_URL = config.TRACE_COLLECTOR_URL  # If set spans are posted there instead of written to file
+
+logger = logging.getLogger(__name__)
+_trace_id = ContextVar('trace_id', default=None)
+_span_id = ContextVar('span_id', default=None)
+
+
+class SpanExporter:
+    """Buffer finished spans and export them in batches from a background thread."""
+
+    def __init__(self, settings, collector_url=None):
+        self.settings = settings
+        self.collector_url = collector_url
+        self.dropped = 0
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._file = None  # Settings and rotating handler of the spans file, opened on first export
+
+    def add(self, span):
+        """Add finished span to the next batch."""
+        with self._condition:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= self.settings['max_buffer']:
+                self.dropped += 1  # Exporting is falling behind, tracing must not use unbounded memory
+                return
+            self._buffer.append(span)
+            if len(self._buffer) >= self.settings['batch_size']:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait(self.settings['flush_interval'])
+                batch, self._buffer = self._buffer, []
+            if batch:
+                try:
+                    self.export(batch)
+                except Exception as e:
+                    logger.warning(f"Exporting {len(batch)} spans failed: {e}")
+
+    def export(self, batch):
+        """Post spans to the collector or append them to the JSON lines file, rotated like the memory log."""
+        if self.collector_url:
+            requests.post(self.collector_url, json={'spans': batch}, timeout=5)
+            return
+        settings = self.settings
+        if self._file and self._file[0] is not settings:
+            self._file[1].close()  # Settings were reloaded, file may have moved
+            self._file = None
+        if not self._file:
+            self._file = settings, RotatingFileHandler(settings['file'], maxBytes=settings['file_bytes'],
+                                                       backupCount=settings['file_backups'])
+        # One record per batch, a batch is never split between rotated files
+        self._file[1].handle(logging.makeLogRecord({'msg': '\n'.join(json.dumps(span) for span in batch)}))
+
+
+EXPORTER = SpanExporter(config.TRACING, TRACE_COLLECTOR_URL)
+
+
+def _apply_reloaded(changed):
+    """Let `EXPORTER` use reloaded settings, buffered spans are exported with them."""
+    if 'TRACING' in changed:
+        EXPORTER.settings = config.TRACING
+
+
+reloader.add_listener(_apply_reloaded)
+
+
+def current_trace_id():
+    """Return id of the trace in the current context or None."""
+    return _trace_id.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the block as a span of the current trace. Without a trace nothing is recorded.
+
+    Args:
+        name [str]: Stage name, eg. 'getters.get_token_pool'.
+        attributes: Additional span data, eg. url.
+    Yields:
+        dict: Span attributes, so the block can add to them.
+    """
+    trace_id = _trace_id.get()
+    if not (trace_id and config.TRACING['enabled']):
+        yield attributes
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = _span_id.get()
+    token = _span_id.set(span_id)
+    start = time.time()
+    error = None
+    try:
+        yield attributes
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _span_id.reset(token)
+        EXPORTER.add({'trace_id': trace_id,
+                      'span_id': span_id,
+                      'parent_id': parent_id,
+                      'name': name,
+                      'start': start,
+                      'duration_ms': (time.time() - start) * 1000,
+                      'attributes': attributes,
+                      'error': error})
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Start a new trace with a root span. Used when an update arrives."""
+    trace_token = _trace_id.set(uuid.uuid4().hex)
+    span_token = _span_id.set(None)
+    try:
+        with span(name, **attributes) as span_attributes:
+            yield span_attributes
+    finally:
+        _span_id.reset(span_token)
+        _trace_id.reset(trace_token)
+
+
+def traced(fun):
+    """Decorate a function so each call is a span named after its module and name."""
+    name = f"{fun.__module__.split('.')[-1]}.{fun.__name__}"
+
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return fun(*args, **kwargs)
+    return wrapper
+
+
+def trace_command(fun):
+    """Decorate a command handler so each update starts a new trace."""
+    @wraps(fun)
+    def wrapper(update, context, *args, **kwargs):
+        message = update.effective_message
+        with trace(f"command.{fun.__name__}",
+                   command=message.text.split()[0] if message and message.text else None,
+                   chat_id=update.effective_chat.id if update.effective_chat else None):
+            return fun(update, context, *args, **kwargs)
+    return wrapper
+
+
+def submit(executor, fun, *args, **kwargs):
+    """Submit a function to an executor so it runs within the current trace."""
+    return executor.submit(copy_context().run, fun, *args, **kwargs)
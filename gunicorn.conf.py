@@ -0,0 +1,18 @@
+"""
+Gunicorn settings, run with `gunicorn -c gunicorn.conf.py run_flask:app`.
+Miha Lotric, Dec 2019
+"""
+import time
+
+
+bind = '127.0.0.1:8080'
+workers = 1  # Every worker runs its own bot once started, more than one would poll telegram twice
+preload_app = True  # Import the app once in the master, workers fork with modules already loaded
+
+
+def post_fork(server, worker):
+    """Give every worker its own connection pools, locks and background threads."""
+    start = time.perf_counter()
+    from cool_defi_bot import forking
+    forking.after_fork()
+    server.log.info(f"Worker {worker.pid} initialized in {time.perf_counter() - start:.3f}s")
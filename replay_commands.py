@@ -0,0 +1,120 @@
+"""
+Script replaying a logged stream of commands against recorded upstream responses and reporting timings.
+Miha Lotric, Dec 2019
+
+Commands are read one per line, as text (`/pools dai`) or as JSON objects with `text` and optional `timestamp`.
+Record responses first by running the bot with `CASSETTE_MODE = record`, then:
+    $ python replay_commands.py commands.txt --latency
+"""
+from collections import defaultdict
+import argparse
+import json
+import time
+
+from cool_defi_bot.api.custom_exceptions import APIError, DataError, FormatError
+from cool_defi_bot.api import api_handlers
+from cool_defi_bot.api import spread_scanner
+from cool_defi_bot.api import returns_table
+from cool_defi_bot.api import cassette
+from cool_defi_bot.api import helpers
+from cool_defi_bot.api import quote_cache
+from cool_defi_bot.api.deadline import budget
+from cool_defi_bot import config
+
+
+def aggregator_command(aggregator):
+    return lambda args: api_handlers.get_aggregator_offer(args, aggregator)
+
+
+COMMANDS = dict([('/pools', lambda args: api_handlers.get_pool(args)[0]),
+                 ('/deepest', lambda args: api_handlers.get_deepest()),
+                 ('/impact', api_handlers.get_price_impact),
+                 ('/spreads', api_handlers.get_spreads),
+                 ('/toppools', api_handlers.get_top_pools)] +
+                [(f'/{command}', aggregator_command(aggregator))
+                 for command, aggregator in config.AGGREGATOR_COMMANDS.items()])
+
+
+def read_commands(path):
+    """Return (timestamp or None, command text) of logged commands."""
+    commands = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                data = json.loads(line)
+                commands.append((data.get('timestamp'), data['text']))
+            else:
+                commands.append((None, line))
+    return commands
+
+
+def run_command(text):
+    """Run a command like the bot does and return (command, seconds, response length, error type or None)."""
+    command, *args = text.split()
+    command = command.split('@')[0].lower()  # Commands in groups can be addressed as /pools@bot
+    fun = COMMANDS.get(command)
+    if not fun:
+        return command, 0, 0, 'Unknown'
+    start = time.perf_counter()
+    error = None
+    response = ''
+    try:
+        with budget(config.DEADLINES['command']):
+            response = fun(args)
+    except (APIError, DataError, FormatError) as e:
+        error = type(e).__name__
+        response = str(e)
+    except Exception as e:
+        error = type(e).__name__
+    return command, time.perf_counter() - start, len(response), error
+
+
+def report(results, total):
+    """Print count, errors and latency percentiles per command."""
+    by_command = defaultdict(list)
+    for command, seconds, _, error in results:
+        by_command[command].append((seconds, error))
+    print(f"{'command':<12}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for command, runs in sorted(by_command.items()):
+        times = sorted(seconds * 1000 for seconds, _ in runs)
+        errors = sum(1 for _, error in runs if error)
+        print(f"{command:<12}{len(runs):>7}{errors:>8}{times[len(times) // 2]:>10.1f}"
+              f"{times[int(len(times) * 0.95)]:>10.1f}{times[-1]:>10.1f}")
+    print(f"{len(results)} commands in {total:.2f}s, upstream responses: {cassette.current().stats}")
+    print(f"Quote cache: {quote_cache.QUOTES.stats()}")
+    for endpoint, stats in sorted(helpers.fetch_stats().items()):
+        print(f"  {endpoint}: {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('commands', help="File with logged commands")
+    parser.add_argument('--cassette', default=config.CASSETTE['path'], help="Recorded upstream responses")
+    parser.add_argument('--latency', action='store_true', help="Replay responses as slowly as they were recorded")
+    parser.add_argument('--pace', action='store_true', help="Keep the logged time between commands")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay the stream several times")
+    parser.add_argument('--jobs', action='store_true', help="Run background jobs first, needed by /spreads")
+    options = parser.parse_args()
+
+    cassette.use(cassette.Cassette(options.cassette, 'replay', latency=options.latency))
+    if options.jobs:
+        spread_scanner.scan_job()
+        returns_table.refresh_job()
+    commands = read_commands(options.commands)
+    results = []
+    start = time.perf_counter()
+    for _ in range(options.repeat):
+        previous = None
+        for timestamp, text in commands:
+            if options.pace and timestamp is not None and previous is not None:
+                time.sleep(max(timestamp - previous, 0))
+            previous = timestamp
+            results.append(run_command(text))
+    report(results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
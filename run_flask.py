@@ -2,47 +2,61 @@
 Script creating and running flask instance which can start/stop telegram bot
 Miha Lotric, Dec 2019
 """
-from flask import Flask, request
-from cool_defi_bot import telegram_bot
+import time
+STARTED = time.perf_counter()  # Import time of the app is reported once it's loaded
+
+from flask import Flask, request, abort, jsonify, send_file
 from cool_defi_bot import config
-from dotenv import load_dotenv
-import requests
-import os
+from cool_defi_bot import profiling
+import logging
 
 
-load_dotenv()  # Load keys from .env file
-SLACK_KEY = os.getenv("SLACK_KEY")  # Slack key to send developers the errors and exceptions
-BOT_TOKEN = os.getenv('BOT_TOKEN')  # Telegram bot token
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 # Add private variables to app
 app._bot_is_live = False 
-app._bot = telegram_bot.get_bot()  # Telegram bot instance
-app._token = BOT_TOKEN
+app._bots = None  # Telegram bot instances, one for each token, created on first start
+app._tokens = config.BOT_TOKENS
+
+
+def get_bots():
+    """Return telegram bot instances, creating them on first use.
+
+    Bots aren't created on import, so gunicorn can preload the app and fork workers before any threads or
+    connections exist.
+    """
+    if app._bots is None:
+        start = time.perf_counter()
+        from cool_defi_bot import telegram_bot  # Imports telegram and api modules
+        app._bots = telegram_bot.get_bots(app._tokens)
+        logger.info(f"{len(app._bots)} bots created in {time.perf_counter() - start:.2f}s")
+    return app._bots
+
+
+def bot_names():
+    """Return addresses of bot instances, used to tell them apart in Slack notifications."""
+    return ', '.join(str(bot).lstrip("<telegram.ext.updater.Updater object at ").rstrip(">") for bot in app._bots)
 
 
 def notify_slack(msg, chat='dev-telegram-bot'):
     """Notify Slack when bot is turned off or on."""
-    params = {'token': SLACK_KEY,
-              'channel': chat,
-              'text': msg,
-              'icon_emoji': ':blocky-cool:',
-              'username': 'Cool Defi Bot',
-              'pretty': 1}
-    url = config.URLS['slack_api']
-    requests.get(url, params=params)
+    from cool_defi_bot import slack
+    slack.post_message(msg, channel=chat, icon_emoji=':blocky-cool:')
 
 
 @app.route('/start', methods=['POST'])
 def start():
-    """If no bot is already running start it."""
+    """If bots aren't already running start them."""
     method = request.args.get('method', 'Unknown')  # Local/Staging/Production
     run_type = 'Auto' if request.args.get('auto') == 'true' else 'Manual'
     if not app._bot_is_live:
         app._bot_is_live = True
         # Starts the listening
-        app._bot.start_polling()
-        notify_slack(f'{run_type} {method} bot started as {str(app._bot).lstrip("<telegram.ext.updater.Updater object at ").rstrip(">")}') 
+        for bot in get_bots():
+            bot.start_polling()
+        notify_slack(f'{run_type} {method} bot started as {bot_names()}')
         return 'Bot started'
     else:
         return 'Already live'
@@ -50,17 +64,97 @@ def start():
 
 @app.route('/stop', methods=['POST'])
 def stop():
-    """If bot is running stop it."""
+    """If bots are running stop them."""
     method = request.args.get('method', 'Unknown')  # Local/Staging/Production
     run_type = 'Auto' if request.args.get('auto') == 'true' else 'Manual'
     if app._bot_is_live:
-        app._bot.stop()
+        for bot in app._bots:
+            bot.stop()
         app._bot_is_live = False
-        notify_slack(f'{run_type} {method} bot stopped as {str(app._bot).lstrip("<telegram.ext.updater.Updater object at ").rstrip(">")}')
+        notify_slack(f'{run_type} {method} bot stopped as {bot_names()}')
         return 'Bot stopped'
     else:
         return 'Already down'
 
 
+def check_profiling_key():
+    """Abort request if it doesn't carry the profiling key."""
+    key = request.headers.get('X-Profiling-Key') or request.args.get('key')
+    if not config.PROFILING_KEY or key != config.PROFILING_KEY:
+        abort(403)
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Return 200 while the app responds and started bots are polling."""
+    polling = [bot.running for bot in app._bots] if app._bot_is_live else []
+    status = 200 if all(polling) else 503
+    return jsonify({'live': status == 200, 'bots_live': app._bot_is_live, 'polling': polling}), status
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Return 200 once bots are running with warm token lists, healthy upstreams and short queues, 503 otherwise."""
+    if not app._bot_is_live:
+        return jsonify({'ready': False, 'failing': ['bots not started']}), 503
+    from cool_defi_bot import health
+    ready, report = health.readiness([bot.dispatcher for bot in app._bots])
+    return jsonify(report), 200 if ready else 503
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Return counters of upstream requests, their hedging, quote cache hits and outbound telegram messages with
+    their queue latency."""
+    check_profiling_key()
+    from cool_defi_bot.api import hedging, helpers, quote_cache
+    from cool_defi_bot import sender
+    return jsonify({'fetches': helpers.fetch_stats(),
+                    'hedging': hedging.HEDGER.stats(),
+                    'quotes': quote_cache.QUOTES.stats(),
+                    'sender': sender.SCHEDULER.stats()})
+
+
+@app.route('/config/reload', methods=['POST'])
+def reload_config():
+    """Apply the settings override file without stopping the bots. Returns names of changed settings."""
+    key = request.headers.get('X-Control-Key') or request.args.get('key')
+    if not config.CONTROL_KEY or key != config.CONTROL_KEY:
+        abort(403)
+    from cool_defi_bot import reloader
+    try:
+        changed = reloader.reload()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'changed': changed})
+
+
+@app.route('/profiling', methods=['POST'])
+def toggle_profiling():
+    """Enable or disable command profiling and memory tracing."""
+    check_profiling_key()
+    to_bool = {'true': True, 'false': False}
+    settings = profiling.configure(enabled=to_bool.get(request.args.get('enabled')),
+                                   memory=to_bool.get(request.args.get('memory')),
+                                   sample_every=request.args.get('every'))
+    return jsonify(settings)
+
+
+@app.route('/profiling/stats', methods=['GET'])
+def profiling_stats():
+    """Return stats of stored command profiles merged together, as pstats file or as text with format=text."""
+    check_profiling_key()
+    stats = profiling.aggregated_stats(sort_by=request.args.get('sort', 'cumulative'))
+    if not stats:
+        return 'No profiles', 404
+    path, text = stats
+    if request.args.get('format') == 'text':
+        return text, 200, {'Content-Type': 'text/plain'}
+    return send_file(path, as_attachment=True, attachment_filename='aggregated.prof')
+
+
+logger.info(f"App loaded in {time.perf_counter() - STARTED:.2f}s")
+
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
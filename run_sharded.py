@@ -0,0 +1,7 @@
+import os
+from cool_defi_bot import sharding
+
+
+processes = int(os.getenv('BOT_PROCESSES', os.cpu_count()))  # Number of worker processes
+print(f"Starting bot with {processes} processes")
+sharding.run_sharded(processes)
@@ -1,6 +1,7 @@
 from cool_defi_bot import telegram_bot
 
 
-bot = telegram_bot.get_bot()
-bot.start_polling()
-print("Bot started")
+bots = telegram_bot.get_bots()  # One for each token in BOT_TOKENS, or BOT_TOKEN
+for bot in bots:
+    bot.start_polling()
+print(f"{len(bots)} bots started")